@@ -1,10 +1,13 @@
 __version__ = '0.1.1'
 from .imports import *
 from .utils import *
+from .attachments import *
 from .messages import *
+from .ratelimits import *
 from .llms import *
 from .prompts import *
 from .agents import *
 from .workflows import *
+from .context import *
 from .conversations import *
 from .multiprompt import *
\ No newline at end of file
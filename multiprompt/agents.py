@@ -10,6 +10,8 @@ class AgentModel:
     max_tokens: int = DEFAULT_MAX_TOKENS
     temperature: float = DEFAULT_TEMP
     verbose: bool = DEFAULT_AGENT_VERBOSE
+    timeout: Optional[float] = None
+    context_tokens: Optional[int] = None
     stash: "BaseHashStash" = None
     output_format = None
     index_by: List[str] = [
@@ -38,6 +40,8 @@ class AgentModel:
         max_tokens: int = None,
         temperature: float = None,
         verbose: bool = None,
+        timeout: Optional[float] = None,
+        context_tokens: Optional[int] = None,
         stash: "BaseHashStash" = None,
         **kwargs,
     ):
@@ -51,6 +55,8 @@ class AgentModel:
         self.max_tokens = max_tokens or self.max_tokens
         self.temperature = temperature or self.temperature
         self.verbose = verbose or self.verbose
+        self.timeout = timeout or self.timeout
+        self.context_tokens = context_tokens or self.context_tokens
         self._agent_prompt = prompt or Prompt(
             model=self.model,
             user_prompt=self.user_prompt,
@@ -62,7 +68,11 @@ class AgentModel:
             **kwargs,
         )
         self._prompt = self._agent_prompt
-        self._prompts = self.stash.get_all(self.key, default=[])
+
+    @cached_property
+    def _prompts(self):
+        # read from the stash on first use, so rebuilding an agent from its config is cheap
+        return self.stash.get_all(self.key, default=[])
 
     @property
     def prompts(self):
@@ -89,7 +99,7 @@ class AgentModel:
                 return prompt
 
         self._prompt = new_prompt
-        self.stash.set(self.key, new_prompt)
+        stash_set_later(self.stash, self.key, new_prompt)
         self._prompts.append(new_prompt)
         return self._prompt
 
@@ -107,8 +117,85 @@ class AgentModel:
     def generate_many_iter(self, user_prompts: List[Union[str, MessageList]], **kwargs):
         return (self.generate(user_prompt, **kwargs) for user_prompt in tqdm(user_prompts))
     
-    def generate_many(self, user_prompts: List[Union[str, MessageList]], **kwargs):
-        return list(self.generate_many_iter(user_prompts, **kwargs))
+    def generate_many(self, user_prompts: List[Union[str, MessageList]], max_concurrency: Optional[int] = DEFAULT_MAX_CONCURRENCY, **kwargs):
+        return [
+            response
+            for _, response in run_async(
+                self.generate_many_async,
+                user_prompts,
+                max_concurrency=max_concurrency,
+                ordered=True,
+                **kwargs,
+            )
+        ]
+
+    async def generate_many_async(
+        self,
+        user_prompts: List[Union[str, MessageList]],
+        max_concurrency: Optional[int] = DEFAULT_MAX_CONCURRENCY,
+        ordered: bool = True,
+        sep="",
+        _force=False,
+        postprocess=False,
+        repr=False,
+        progress=True,
+        **prompt_kwargs,
+    ) -> AsyncGenerator[Tuple[int, Any], None]:
+        """Generate responses for many prompts with at most `max_concurrency` calls in flight.
+
+        Yields (index, response) pairs, in input order if `ordered` else as they finish.
+        Prompts already in the stash are answered directly without taking a slot.
+        """
+        user_prompts = list(user_prompts)
+        semaphore = asyncio.Semaphore(max_concurrency or max(len(user_prompts), 1))
+        results = asyncio.Queue()
+        tasks = []
+
+        async def run_one(i, prompt):
+            try:
+                tokens = await collect_async_generator(prompt.generate_async(_force=True))
+                results.put_nowait((i, prompt.format_response(tokens, sep=sep), None))
+            except Exception as e:
+                results.put_nowait((i, None, e))
+            finally:
+                semaphore.release()
+
+        async def feed():
+            try:
+                for i, user_prompt in enumerate(user_prompts):
+                    prompt = self.prompt(user_prompt=user_prompt, **prompt_kwargs)
+                    if not _force and prompt.is_stashed:
+                        results.put_nowait((i, prompt.generate(sep=sep), None))
+                        continue
+                    await semaphore.acquire()
+                    tasks.append(asyncio.ensure_future(run_one(i, prompt)))
+            except Exception as e:
+                results.put_nowait((None, None, e))
+
+        feeder = asyncio.ensure_future(feed())
+        pending = {}
+        next_i = 0
+        try:
+            for _ in tqdm(range(len(user_prompts)), disable=not progress):
+                i, response, error = await results.get()
+                if error is not None:
+                    raise error
+                if postprocess or repr:
+                    response = self.postprocess_output(response)
+                if repr:
+                    response = self.represent_output(response)
+                if not ordered:
+                    yield i, response
+                    continue
+                pending[i] = response
+                while next_i in pending:
+                    yield next_i, pending.pop(next_i)
+                    next_i += 1
+        finally:
+            for task in [feeder, *tasks]:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(feeder, *tasks, return_exceptions=True)
 
     def generate(
         self,
@@ -159,10 +246,19 @@ class AgentModel:
             "agent": self.name,
             "position": self.position,
             "prompt": self._prompt.to_dict(),
+            **({"timeout": self.timeout} if self.timeout is not None else {}),
+            **({"context_tokens": self.context_tokens} if self.context_tokens is not None else {}),
         }
+
+    @property
+    def config(self) -> AgentConfig:
+        """Like to_dict, but with the agent's own prompt rather than the last one it
+        ran, which may hold a whole conversation."""
+        return {**self.to_dict(), "prompt": self._agent_prompt.to_dict()}
     
     def __hash__(self):
-        return hash(serialize(self.to_dict()))
+        # by config, which does not change as the agent runs prompts
+        return hash(serialize(self.config))
 
     @property
     def response(self):
@@ -236,12 +332,14 @@ class AgentModel:
             "name": name or self.name,
             "position": position or self.position,
             "prompt": prompt.to_dict(),
+            "timeout": self.timeout,
+            "context_tokens": self.context_tokens,
         }
         new = self.__class__.from_dict(inpd)
         return self if new == self else new
 
     def __eq__(self, other):
-        return self.to_dict() == other.to_dict()
+        return self.config == other.config
 
     @property
     def responses(self):
@@ -363,6 +461,10 @@ class AlgorithmicAgent(AgentModel):
             "position": self.position,
             "algorithm_func": stuff(self.algorithm_func),
         }
+
+    @property
+    def config(self) -> AgentConfig:
+        return self.to_dict()
     
     @classmethod
     def from_dict(cls, data: AgentConfig) -> "AlgorithmicAgent":
@@ -422,6 +524,14 @@ def Agent(name: str, **kwargs) -> AgentModel:
     return AgentModel(name=name, **kwargs)
 
 
+def agent_from_config(config: Union[AgentConfig, AgentModel]) -> AgentModel:
+    """Rebuild an agent from its `config`; agents pickled whole pass through."""
+    if isinstance(config, AgentModel):
+        return config
+    cls = AlgorithmicAgent if "algorithm_func" in config else AgentModel
+    return cls.from_dict(dict(config))
+
+
 @cache
 def get_agents_json() -> List[Dict[str, Any]]:
     o = {}
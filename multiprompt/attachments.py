@@ -0,0 +1,188 @@
+from .imports import *
+import io
+import mmap
+
+IMAGE_MIMES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp", "BMP": "image/bmp"}
+
+
+def detect_image_format(data: bytes) -> Optional[str]:
+    """Image format from its magic bytes, as a Pillow format name."""
+    header = bytes(data[:12])
+    if header.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    if header.startswith(b"BM"):
+        return "BMP"
+    return None
+
+
+class ImagePipeline:
+    """Shrinks image attachments before they are base64-encoded into a request.
+
+    Images are downscaled to fit `max_size` pixels on their longest side and
+    re-encoded as `format` at `quality`, unless that would not make them smaller.
+    Results are cached on disk by content hash and settings. Without Pillow, images
+    pass through unchanged but are labelled with their true format.
+    """
+
+    def __init__(self, path: str = PATH_IMAGE_CACHE, format: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY):
+        self.path = path
+        self.format = format
+        self.quality = quality
+        self.num_processed = 0
+        self.disk_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_time = 0.0
+
+    def cache_path(self, data: bytes, max_size: Optional[int]) -> str:
+        digest = hashlib.sha256(data)
+        digest.update(f"{max_size}:{self.format}:{self.quality}".encode())
+        return os.path.join(self.path, digest.hexdigest())
+
+    def process(self, data: bytes, max_size: Optional[int] = None) -> Tuple[str, bytes]:
+        """(mime type, image bytes) to send for the image `data`."""
+        format = detect_image_format(data) or "JPEG"
+        try:
+            from PIL import Image
+        except ImportError:
+            return IMAGE_MIMES[format], data
+
+        path = self.cache_path(data, max_size)
+        for cached_format, mime in IMAGE_MIMES.items():
+            if os.path.exists(f"{path}.{cached_format.lower()}"):
+                self.disk_hits += 1
+                with open(f"{path}.{cached_format.lower()}", "rb") as f:
+                    return mime, f.read()
+
+        started = time.perf_counter()
+        try:
+            out_format, out = self.reencode(Image.open(io.BytesIO(data)), data, format, max_size)
+        except Exception as e:
+            logger.warning(f"Could not process image, sending it as is: {e}")
+            return IMAGE_MIMES[format], data
+        self.encode_time += time.perf_counter() - started
+        self.num_processed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        os.makedirs(self.path, exist_ok=True)
+        with open(f"{path}.{out_format.lower()}", "wb") as f:
+            f.write(out)
+        return IMAGE_MIMES[out_format], out
+
+    def reencode(self, img, data: bytes, format: str, max_size: Optional[int]) -> Tuple[str, bytes]:
+        if getattr(img, "n_frames", 1) > 1:
+            return format, data  # keep animations intact
+        resized = bool(max_size) and max(img.size) > max_size
+        if resized:
+            img.thumbnail((max_size, max_size))
+        has_alpha = "A" in img.getbands() or "transparency" in img.info
+        if img.mode not in ("RGB", "RGBA") or (has_alpha and self.format == "JPEG"):
+            img = img.convert("RGBA" if has_alpha and self.format != "JPEG" else "RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format=self.format, quality=self.quality)
+        out = buffer.getvalue()
+        if not resized and len(out) >= len(data):
+            return format, data
+        return self.format, out
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "processed": self.num_processed,
+            "disk_hits": self.disk_hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "encode_time": self.encode_time,
+        }
+
+
+IMAGES = ImagePipeline()
+
+
+class AttachmentCache:
+    """Attachment payloads shared between messages, keyed by (path, mtime, size).
+
+    Files are read the first time a message needs them; later messages with the same
+    layout reuse the very same content part, so only a stat call touches the disk.
+    Files of `mmap_threshold` bytes or more are read through mmap. Images go through
+    the ImagePipeline for the requested maximum size.
+    """
+
+    def __init__(self, max_bytes: int = ATTACHMENT_CACHE_MAX_BYTES, mmap_threshold: int = ATTACHMENT_MMAP_THRESHOLD):
+        self.cache = LRUCache(max_bytes)
+        self.mmap_threshold = mmap_threshold
+        self.bytes_read = 0
+        self.mmap_reads = 0
+
+    @staticmethod
+    def file_key(path: str) -> Tuple[str, int, int]:
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+    def read_bytes(self, path: str, size: int, decode: Callable[[Any], Any]) -> Any:
+        self.bytes_read += size
+        with open(path, "rb") as f:
+            if size < self.mmap_threshold:
+                return decode(f.read())
+            self.mmap_reads += 1
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    return decode(view)
+                finally:
+                    view.release()
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        part = self.cache.get(key)
+        if part is None:
+            part = build()
+            self.cache.set(key, part)
+        return part
+
+    def read_text(self, path: str) -> str:
+        _, _, size = self.file_key(path)
+        text = self.read_bytes(path, size, lambda data: codecs.decode(data, "utf-8", errors="replace"))
+        # as open(path, "r") would
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def text_part(self, path: str, relpath: str, continued: bool = False) -> Dict[str, Any]:
+        key = ("text", *self.file_key(path), relpath, continued)
+
+        def build():
+            ext = os.path.splitext(path)[-1].lstrip(".")
+            file_content = self.read_text(path)
+            return {
+                "type": "text",
+                "text": f"## Appendix to user prompt{' (continued)' if continued else ''}\n\n### Contents of file: `{relpath}`\n\n```{ext}\n{file_content}```",
+                "attachment": path,
+            }
+
+        return self.get(key, build)
+
+    def image_part(self, path: str, max_size: Optional[int] = DEFAULT_IMAGE_MAX_SIZE) -> Dict[str, Any]:
+        key = ("image", *self.file_key(path), max_size)
+
+        def build():
+            mime, data = IMAGES.process(self.read_bytes(path, key[-2], bytes), max_size)
+            return {
+                "type": "image_url",
+                "image_url": {"url": f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"},
+                "attachment": path,
+                "max_size": max_size,
+            }
+
+        return self.get(key, build)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {**self.cache.stats, "bytes_read": self.bytes_read, "mmap_reads": self.mmap_reads, "images": IMAGES.stats}
+
+
+ATTACHMENTS = AttachmentCache()
@@ -0,0 +1,384 @@
+from .imports import *
+from .utils import *
+from .messages import *
+from .llms import *
+from .prompts import *
+from .agents import *
+from .workflows import *
+from .repo2llm import *
+from .conversations import ConversationModel, ConversationStore
+import platform
+import subprocess
+import datetime
+
+BENCH_MODEL = "mock/bench?tokens=32"
+BENCH_SLOW_MODEL = "mock/bench-slow?ttft=0.05&delay=0.002&tokens=32"
+BENCH_SUITES = ["stash", "workflow", "server", "conversations", "repo", "messages"]
+BENCH_RUN_TIMEOUT = 60.0
+
+
+def summarize_timings(timings: List[float]) -> Dict[str, float]:
+    if not timings:
+        return {"n": 0}
+    timings = sorted(timings)
+    return {
+        "n": len(timings),
+        "total": sum(timings),
+        "mean": sum(timings) / len(timings),
+        "p50": LatencyStats.quantile(timings, 0.5),
+        "p95": LatencyStats.quantile(timings, 0.95),
+        "p99": LatencyStats.quantile(timings, 0.99),
+        "max": timings[-1],
+    }
+
+
+def timed(func, *args, **kwargs) -> float:
+    started = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def bench_stash(num_prompts: int = 200, model: str = BENCH_MODEL) -> Dict[str, Any]:
+    disk_stash = HashStash(os.path.join(PATH_DATA, "bench_stash"), append_mode=True)
+    stash = CachedStash(disk_stash, max_bytes=STASH_CACHE_MAX_BYTES)
+    run_id = uuid.uuid4().hex
+    user_prompts = [f"bench {run_id} prompt {i}" for i in range(num_prompts)]
+    miss = [timed(Prompt(user_prompt=p, model=model, stash=stash).generate) for p in user_prompts]
+    hit = [timed(Prompt(user_prompt=p, model=model, stash=stash).generate) for p in user_prompts]
+    hit_disk = [timed(Prompt(user_prompt=p, model=model, stash=disk_stash).generate) for p in user_prompts]
+    return {
+        "model": model,
+        "miss": summarize_timings(miss),
+        "hit": summarize_timings(hit),
+        "hit_disk": summarize_timings(hit_disk),
+        "cache": stash.stats,
+    }
+
+
+def bench_workflow(
+    num_runs: int = 20,
+    num_positions: int = 2,
+    agents_per_position: int = 3,
+    max_concurrency: Optional[int] = DEFAULT_MAX_CONCURRENCY,
+    model: str = BENCH_SLOW_MODEL,
+) -> Dict[str, Any]:
+    run_id = uuid.uuid4().hex
+
+    def make_workflow(run):
+        return Workflow(
+            [
+                [
+                    AgentModel(name=f"bench-{pos}-{i}", model=model, user_prompt=f"bench {run_id} run {run}")
+                    for i in range(agents_per_position)
+                ]
+                for pos in range(num_positions)
+            ],
+            max_concurrency=max_concurrency,
+        )
+
+    async def run_all():
+        await asyncio.gather(*[make_workflow(run).run_async() for run in range(num_runs)])
+
+    # agents in one position share a prompt, and so one provider call: count the calls
+    # the mock provider actually served
+    llm = LLM(model=model)
+    requests_before = llm.num_requests
+    elapsed = timed(run_sync, run_all)
+    num_calls = llm.num_requests - requests_before
+    return {
+        "model": model,
+        "runs": num_runs,
+        "agent_runs": num_runs * num_positions * agents_per_position,
+        "calls": num_calls,
+        "elapsed": elapsed,
+        "runs_per_sec": num_runs / elapsed,
+        "calls_per_sec": num_calls / elapsed,
+    }
+
+
+def bench_server(
+    num_clients: int = 10,
+    num_agents: int = 3,
+    model: str = BENCH_SLOW_MODEL,
+    run_timeout: float = BENCH_RUN_TIMEOUT,
+) -> Dict[str, Any]:
+    """Both emit modes against one server, in one event loop: the server's app and
+    socket.io instance are bound to the loop that first serves them."""
+    import socket
+    from aiohttp import web
+    from .server import app
+
+    async def run_all():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        site = web.SockSite(runner, sock)
+        await site.start()
+        url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+        try:
+            return {
+                emit_mode: await bench_server_mode(
+                    url, num_clients=num_clients, num_agents=num_agents, model=model, emit_mode=emit_mode, run_timeout=run_timeout
+                )
+                for emit_mode in ["token", "batch"]
+            }
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run_all())
+
+
+async def bench_server_mode(
+    url: str,
+    num_clients: int = 10,
+    num_agents: int = 3,
+    model: str = BENCH_SLOW_MODEL,
+    emit_mode: str = "token",
+    run_timeout: float = BENCH_RUN_TIMEOUT,
+) -> Dict[str, Any]:
+    """A client that errors, or sees no conversation_complete within `run_timeout`
+    seconds, counts as a failure rather than a latency; a mode in which every client
+    fails raises rather than reporting numbers."""
+    import socketio
+    from .server import emit_stats
+
+    run_id = uuid.uuid4().hex
+
+    async def run_client(i, counts, latencies, failures):
+        client = socketio.AsyncClient()
+        done = asyncio.Event()
+        errors = []
+        started = time.perf_counter()
+
+        @client.on("response")
+        async def on_response(data):
+            counts[i] += 1
+
+        @client.on("response_batch")
+        async def on_response_batch(data):
+            counts[i] += len(data["tokens"])
+
+        @client.on("conversation_complete")
+        async def on_complete(data):
+            done.set()
+
+        @client.on("error")
+        async def on_error(data):
+            logger.error(f"bench client {i}: {data}")
+            errors.append(data)
+            done.set()
+
+        @client.on("rejected")
+        async def on_rejected(data):
+            errors.append(data)
+            done.set()
+
+        await client.connect(url, transports=["websocket"])
+        await client.emit(
+            "converse",
+            {
+                "userPrompt": f"bench {run_id} client {i}",
+                "agents": [{"name": f"bench-agent-{j}", "model": model} for j in range(num_agents)],
+                "emitMode": emit_mode,
+            },
+        )
+        try:
+            await asyncio.wait_for(done.wait(), run_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"bench client {i}: no conversation_complete within {run_timeout}s")
+            failures.append({"client": i, "error": "timeout"})
+        else:
+            if errors:
+                failures.append({"client": i, "error": str(errors[0])})
+            else:
+                latencies.append(time.perf_counter() - started)
+        finally:
+            await client.disconnect()
+
+    counts, latencies, failures = [0] * num_clients, [], []
+    emit_stats.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*[run_client(i, counts, latencies, failures) for i in range(num_clients)])
+    elapsed = time.perf_counter() - started
+    if not latencies:
+        raise RuntimeError(f"No server benchmark client finished a conversation ({emit_mode} mode): {failures[:3]}")
+    return {
+        "model": model,
+        "clients": num_clients,
+        "agents": num_agents,
+        "tokens": sum(counts),
+        "elapsed": elapsed,
+        "tokens_per_sec": sum(counts) / elapsed,
+        "emits": emit_stats.stats,
+        "conversation_latency": summarize_timings(latencies),
+        "failures": failures,
+    }
+
+
+def bench_conversations(num_conversations: int = 20, num_rounds: int = 3, num_agents: int = 2, model: str = BENCH_MODEL) -> Dict[str, Any]:
+    """Save conversations to a store too small to keep any of them, so each is evicted,
+    then reload them; a reloaded conversation that differs from the one saved is an error."""
+    run_id = uuid.uuid4().hex
+    convos = [
+        ConversationModel(agents=[{"name": f"bench-agent-{j}", "model": model} for j in range(num_agents)])
+        for _ in range(num_conversations)
+    ]
+
+    async def run_all():
+        for convo in convos:
+            for k in range(num_rounds):
+                await collect_async_generator(convo.add_round(f"bench {run_id} round {k}").run_async())
+            await convo.context.drain()
+
+    run_sync(run_all)
+    with tempfile.TemporaryDirectory() as root:
+        store = ConversationStore(os.path.join(root, "conversations.sqlite"), max_bytes=0)
+        save = [timed(store.save, convo) for convo in convos]
+        if len(store):
+            raise RuntimeError(f"{len(store)} conversations were not evicted")
+        load = []
+        for convo in convos:
+            started = time.perf_counter()
+            reloaded = store.get(convo.id)
+            load.append(time.perf_counter() - started)
+            if reloaded is None or reloaded.to_dict() != convo.to_dict() or reloaded.log.to_list() != convo.log.to_list():
+                raise RuntimeError(f"conversation {convo.id} did not survive eviction")
+        return {
+            "conversations": num_conversations,
+            "rounds": num_rounds,
+            "save": summarize_timings(save),
+            "load": summarize_timings(load),
+            "store": store.stats,
+        }
+
+
+def make_bench_repo(root: str, num_files: int = 500, file_size: int = 2000, files_per_dir: int = 20) -> str:
+    rng = random.Random(0)
+    words = MockLLM.vocabulary
+    for i in range(num_files):
+        subdir = os.path.join(root, "src", f"pkg{i // files_per_dir}")
+        os.makedirs(subdir, exist_ok=True)
+        ext = [".py", ".js", ".md"][i % 3]
+        comment = {".py": "# ", ".js": "// ", ".md": ""}[ext]
+        lines, size = [], 0
+        while size < file_size:
+            line = (comment if rng.random() < 0.2 else "") + " ".join(rng.choice(words) for _ in range(8))
+            lines.append(line)
+            size += len(line) + 1
+        with open(os.path.join(subdir, f"file{i}{ext}"), "w") as f:
+            f.write("\n".join(lines))
+    # ignored content that a walk should not pay for
+    os.makedirs(os.path.join(root, "node_modules", "dep"), exist_ok=True)
+    for i in range(num_files // 5):
+        with open(os.path.join(root, "node_modules", "dep", f"mod{i}.js"), "w") as f:
+            f.write("module.exports = {};\n")
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("node_modules/\n")
+    return root
+
+
+def bench_repo(num_files: int = 500, file_size: int = 2000, repeat: int = 3) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as root:
+        make_bench_repo(root, num_files=num_files, file_size=file_size)
+        timings, num_chars = [], 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            num_chars = len(LocalReader(root).markdown)
+            timings.append(time.perf_counter() - started)
+    return {
+        "files": num_files,
+        "file_size": file_size,
+        "markdown_chars": num_chars,
+        "timings": summarize_timings(timings),
+        "files_per_sec": num_files / min(timings),
+    }
+
+
+def bench_messages(num_attachments: int = 20, attachment_kb: int = 256, repeat: int = 10) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for i in range(num_attachments):
+            path = os.path.join(root, f"attachment{i}.txt")
+            with open(path, "w") as f:
+                f.write(("x" * 79 + "\n") * (attachment_kb * 1024 // 80))
+            paths.append(path)
+        timings = [
+            timed(MessageList.from_prompt, user_prompt="bench", attachments=paths, system_prompt=DEFAULT_SYSTEM_PROMPT)
+            for _ in range(repeat)
+        ]
+    return {
+        "attachments": num_attachments,
+        "attachment_kb": attachment_kb,
+        "timings": summarize_timings(timings),
+    }
+
+
+def get_bench_meta() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PATH_REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    from . import __version__
+    return {
+        "version": __version__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": datetime.datetime.now().isoformat(),
+    }
+
+
+def run_bench(suites: List[str] = BENCH_SUITES, **options) -> Dict[str, Any]:
+    funcs = {
+        "stash": lambda: bench_stash(num_prompts=options.get("prompts", 200)),
+        "workflow": lambda: bench_workflow(num_runs=options.get("runs", 20), max_concurrency=options.get("concurrency")),
+        "server": lambda: bench_server(
+            num_clients=options.get("clients", 10), run_timeout=options.get("run_timeout", BENCH_RUN_TIMEOUT)
+        ),
+        "conversations": lambda: bench_conversations(num_conversations=options.get("conversations", 20)),
+        "repo": lambda: bench_repo(num_files=options.get("repo_files", 500)),
+        "messages": lambda: bench_messages(attachment_kb=options.get("attachment_kb", 256)),
+    }
+    results = {}
+    for suite in suites:
+        print(f"Running {suite} benchmark...", file=sys.stderr)
+        results[suite] = funcs[suite]()
+    return {"meta": {**get_bench_meta(), "options": options}, "results": results}
+
+
+def add_bench_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-o", "--output", default="bench.json", help="JSON results file (default: bench.json)")
+    parser.add_argument("--suites", default=",".join(BENCH_SUITES), help=f"Comma-separated suites (default: {','.join(BENCH_SUITES)})")
+    parser.add_argument("--prompts", type=int, default=200, help="Prompts for the stash benchmark")
+    parser.add_argument("--runs", type=int, default=20, help="Concurrent workflow runs")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Workflow per-position concurrency cap")
+    parser.add_argument("--clients", type=int, default=10, help="Simulated socket.io clients")
+    parser.add_argument("--run-timeout", type=float, default=BENCH_RUN_TIMEOUT, help="Seconds before a server benchmark client counts as failed")
+    parser.add_argument("--conversations", type=int, default=20, help="Conversations saved, evicted and reloaded")
+    parser.add_argument("--repo-files", type=int, default=500, help="Files in the generated repository")
+    parser.add_argument("--attachment-kb", type=int, default=256, help="Size of each attachment in KB")
+
+
+def main(args: argparse.Namespace):
+    """Runs the suites in a subprocess whose MULTIPROMPT_HOME is a scratch directory,
+    so benchmark stashes never touch (or get warmed by) the user's data."""
+    with tempfile.TemporaryDirectory() as home:
+        argv = [sys.executable, "-m", "multiprompt.bench"] + [
+            f"--{k.replace('_', '-')}={v}" for k, v in vars(args).items() if k != "command" and v is not None
+        ]
+        subprocess.run(argv, env={**os.environ, "MULTIPROMPT_HOME": home}, cwd=os.getcwd(), check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="multiprompt benchmark suite")
+    add_bench_arguments(parser)
+    args = parser.parse_args()
+    options = {k: v for k, v in vars(args).items() if k not in {"output", "suites"}}
+    out = run_bench([s for s in args.suites.split(",") if s], **options)
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"Benchmark results written to {args.output}", file=sys.stderr)
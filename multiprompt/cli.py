@@ -1,6 +1,8 @@
 import argparse
+from .imports import SERVER_HOST, SERVER_PORT, SERVER_WORKERS, REPO2LLM_WATCH_DEBOUNCE
 from .server import main as server_main
 from .repo2llm import main as repo_main
+from .bench import main as bench_main, add_bench_arguments
 
 def main():
     parser = argparse.ArgumentParser(description="multiprompt command-line tool")
@@ -10,17 +12,27 @@ def main():
     copy_parser = subparsers.add_parser("copy", help="Run repo2llm on a path")
     copy_parser.add_argument("path", help="Path to the repository or GitHub URL")
     copy_parser.add_argument("-o", "--output", help="Output file path (default: .robots.md)", default='.robots.md')
+    copy_parser.add_argument("--no-clipboard", dest="clipboard", action="store_false", help="Do not copy the output to the clipboard; copying holds the whole document in memory, so skip it to keep memory bounded on large repositories")
+    copy_parser.add_argument("--watch", action="store_true", help="Keep the output up to date as files change")
+    copy_parser.add_argument("--debounce", type=float, default=REPO2LLM_WATCH_DEBOUNCE, help=f"Seconds of quiet before regenerating in watch mode (default: {REPO2LLM_WATCH_DEBOUNCE})")
 
     # Server command
     server_parser = subparsers.add_parser("server", help="Start the multiprompt server")
-    server_parser.add_argument("--host", default="127.0.0.1", help="Host to run the server on")
-    server_parser.add_argument("--port", type=int, default=8000, help="Port to run the server on")
+    server_parser.add_argument("--host", default=SERVER_HOST, help=f"Host to run the server on (default: {SERVER_HOST})")
+    server_parser.add_argument("--port", type=int, default=SERVER_PORT, help=f"Port to run the server on (default: {SERVER_PORT})")
+    server_parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="Worker processes behind a sticky proxy (default: 1)")
+
+    # Bench command
+    bench_parser = subparsers.add_parser("bench", help="Run the benchmark suite against a local mock provider")
+    add_bench_arguments(bench_parser)
 
     args = parser.parse_args()
     if args.command == "copy":
-        repo_main(args.path, output_file=args.output)
+        repo_main(args.path, output_file=args.output, watch=args.watch, debounce=args.debounce, clipboard=args.clipboard)
     elif args.command == "server":
-        server_main()
+        server_main(host=args.host, port=args.port, workers=args.workers)
+    elif args.command == "bench":
+        bench_main(args)
     else:
         parser.print_help()
 
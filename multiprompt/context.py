@@ -0,0 +1,156 @@
+from .imports import *
+from .messages import Message, MessageList, extend_messages
+from .llms import BaseLLM
+from .prompts import Prompt
+
+
+@cache
+def get_context_window(model: str) -> Optional[int]:
+    try:
+        info = litellm.get_model_info(model)
+    except Exception:
+        return None
+    return info.get("max_input_tokens") or info.get("max_tokens")
+
+
+def count_tokens(messages: List[Message], model: str) -> int:
+    msgs = [{"role": msg.role, "content": msg.get_text()} for msg in messages]
+    if not model.startswith("mock/"):
+        try:
+            return litellm.token_counter(model=model, messages=msgs)
+        except Exception:
+            pass
+    return BaseLLM.estimate_tokens(msgs)
+
+
+class ContextManager:
+    """Fits a conversation's history into each agent's token budget.
+
+    The last `keep_rounds` rounds stay verbatim. Older rounds are swapped for their
+    summaries, oldest first, until the prompt fits, and summaries are dropped after
+    that if need be. Summaries are made by `summary_model` in the background as
+    each round finishes, once the history passes `summarize_at` of the smallest
+    budget, so they are normally ready before a prompt needs them. A round whose
+    summary fails stays verbatim.
+    """
+
+    def __init__(
+        self,
+        keep_rounds: int = CONTEXT_KEEP_ROUNDS,
+        summary_model: str = DEFAULT_SUMMARY_MODEL,
+        summarize_at: float = CONTEXT_SUMMARIZE_AT,
+    ):
+        self.keep_rounds = keep_rounds
+        self.summary_model = summary_model
+        self.summarize_at = summarize_at
+        # background summaries from `schedule`, kept so their errors surface
+        self.tasks: Set[asyncio.Future] = set()
+
+    def budget(self, agent) -> Optional[int]:
+        """Prompt tokens available to `agent`: its `context_tokens` if set, else its
+        model's context window less the completion budget."""
+        if getattr(agent, "context_tokens", None):
+            return agent.context_tokens
+        window = get_context_window(agent.model)
+        return window - (agent.max_tokens or 0) if window else None
+
+    def round_tokens(self, round, model: str) -> int:
+        if model not in round.token_counts:
+            round.token_counts[model] = count_tokens(round.own_messages, model)
+        return round.token_counts[model]
+
+    def summary_tokens(self, round, model: str) -> int:
+        return count_tokens([Message(role="user", content=round.summary)], model)
+
+    async def fit(self, round, agent) -> MessageList:
+        budget = self.budget(agent)
+        if budget is None:
+            return round.messages
+        previous = self.previous(round)
+        history_tokens = [self.round_tokens(r, agent.model) for r in previous]
+        total = count_tokens(round.own_messages, agent.model) + sum(history_tokens)
+        if total <= budget:
+            return round.messages
+
+        summarized = {}
+        for k, r in enumerate(previous[: max(0, len(previous) - self.keep_rounds)]):
+            if total <= budget:
+                break
+            summary = await self.get_summary(r)
+            if summary:
+                summarized[k] = summary
+                total += self.summary_tokens(r, agent.model) - history_tokens[k]
+        for k in sorted(summarized):
+            if total <= budget:
+                break
+            total -= self.summary_tokens(previous[k], agent.model)
+            summarized[k] = None
+        logger.debug(f"Fitted round {round.num} for {agent.name} into ~{total} of {budget} tokens")
+        return self.assemble(round, previous, summarized)
+
+    @staticmethod
+    def previous(round) -> List[Any]:
+        """The rounds in `round.history`: those committed before its offset was pinned
+        (and, of those, only ones that came before it)."""
+        round.pin_history()
+        commits = round.conversation.commits[: round.prior_commits]
+        return [r for r in commits if r.i < round.i]
+
+    def assemble(self, round, previous: List[Any], summarized: Dict[int, Optional[str]]) -> MessageList:
+        messages = MessageList()
+        summaries = [f"Round {previous[k].num}: {summarized[k]}" for k in sorted(summarized) if summarized[k]]
+        if summaries:
+            messages.add_user_message("## Summary of earlier rounds\n\n" + "\n\n".join(summaries))
+        for k, r in enumerate(previous):
+            if k not in summarized:
+                extend_messages(messages, r.own_messages)
+        extend_messages(messages, round.own_messages)
+        return messages
+
+    async def get_summary(self, round) -> Optional[str]:
+        if round.summary is None:
+            if round.summary_task is None:
+                round.summary_task = asyncio.ensure_future(self.summarize(round))
+            await asyncio.shield(round.summary_task)
+        return round.summary
+
+    async def summarize(self, round) -> Optional[str]:
+        text = "\n\n".join(f"[{msg.role.upper()}]\n{msg.get_text()}" for msg in round.own_messages)
+        prompt = Prompt(
+            user_prompt=text,
+            system_prompt=CONTEXT_SUMMARY_SYSTEM_PROMPT,
+            model=self.summary_model,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+        )
+        try:
+            round.summary = "".join([token async for token in prompt.generate_async()]).strip() or None
+        except Exception as e:
+            logger.warning(f"Could not summarize round {round.num} of conversation {round.conversation_id}: {e}")
+        return round.summary
+
+    def schedule(self, conversation):
+        """Start background summaries for rounds that have left the verbatim window,
+        once the history is large enough that some prompt may soon need them."""
+        budgets = [(self.budget(agent), agent) for agent in conversation.agents]
+        budgets = [(budget, agent) for budget, agent in budgets if budget]
+        if not budgets:
+            return
+        budget, agent = min(budgets, key=lambda ba: ba[0])
+        committed = list(conversation.commits)
+        if sum(self.round_tokens(r, agent.model) for r in committed) < self.summarize_at * budget:
+            return
+        for r in committed[: max(0, len(committed) - self.keep_rounds)]:
+            if r.summary is None and r.summary_task is None:
+                r.summary_task = asyncio.ensure_future(self.summarize(r))
+                self.tasks.add(r.summary_task)
+                r.summary_task.add_done_callback(self.task_done)
+
+    def task_done(self, task: asyncio.Future):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background summary failed: {task.exception()!r}")
+
+    async def drain(self):
+        """Wait for the background summaries, raising the first error among them."""
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks))
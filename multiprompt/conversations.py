@@ -2,25 +2,211 @@ from .imports import *
 from .agents import *
 from .llms import *
 from .utils import *
-from .messages import Message, MessageList
+from .messages import Message, MessageList, MessageLogView, extend_messages
+from .context import ContextManager
 
-conversations: Dict[str, 'ConversationModel'] = {}
+
+class ConversationConflict(Exception):
+    pass
+
+
+class ConversationStore:
+    """Conversation state shared between server workers through one SQLite file.
+
+    Each process keeps the conversations it has touched in memory, up to `max_bytes`
+    of pickled state; past that, the least recently used idle conversations are
+    written through and dropped, and rehydrated from disk on their next lookup.
+    A conversation is also reloaded whenever another process saved a newer version.
+    A save only lands if it is newer than the stored version; otherwise it raises
+    ConversationConflict and the stored version is reloaded on the next lookup.
+    """
+
+    def __init__(self, path: str = PATH_CONVERSATIONS, max_bytes: int = CONVERSATION_STORE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.resident: "OrderedDict[str, ConversationModel]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.rehydrations = 0
+        self.evictions = 0
+        self.local = threading.local()
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(id TEXT PRIMARY KEY, version INTEGER NOT NULL, state BLOB NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def __contains__(self, id) -> bool:
+        return id in self.resident or self.stored_version(id) is not None
+
+    def __getitem__(self, id) -> 'ConversationModel':
+        convo = self.get(id)
+        if convo is None:
+            raise KeyError(id)
+        return convo
+
+    def __setitem__(self, id, convo: 'ConversationModel'):
+        self.remember(convo)
+
+    def __len__(self) -> int:
+        return len(self.resident)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "resident": len(self.resident),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rehydrations": self.rehydrations,
+            "evictions": self.evictions,
+        }
+
+    def remember(self, convo: 'ConversationModel', size: Optional[int] = None):
+        """Mark `convo` as most recently used, with `size` bytes of state if known."""
+        self.resident[convo.id] = convo
+        self.resident.move_to_end(convo.id)
+        if size is not None:
+            self.nbytes += size - self.sizes.get(convo.id, 0)
+            self.sizes[convo.id] = size
+        self.evict()
+
+    def forget(self, id: str):
+        self.resident.pop(id, None)
+        self.nbytes -= self.sizes.pop(id, 0)
+
+    def evict(self):
+        for id in list(self.resident):
+            if self.nbytes <= self.max_bytes:
+                break
+            convo = self.resident[id]
+            if convo.active:
+                continue
+            if convo.dirty and not self.write(*self.dump(convo)):
+                logger.warning(f"Dropped changes to conversation {id}: another process saved it first")
+            self.forget(id)
+            self.evictions += 1
+
+    def stored_version(self, id) -> Optional[int]:
+        row = self.connect().execute("SELECT version FROM conversations WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def fetch(self, id, version: Optional[int] = None) -> Optional[Tuple[int, bytes]]:
+        """The stored version and state of `id`, if newer than `version`."""
+        return self.connect().execute(
+            "SELECT version, state FROM conversations WHERE id = ? AND version > ?",
+            (id, -1 if version is None else version),
+        ).fetchone()
+
+    def get(self, id) -> Optional['ConversationModel']:
+        if id is None:
+            return None
+        convo = self.resident.get(id)
+        return self.adopt(id, self.fetch(id, convo.version if convo is not None else None))
+
+    async def get_async(self, id) -> Optional['ConversationModel']:
+        """Like `get`, with the SQLite read on a thread."""
+        if id is None:
+            return None
+        convo = self.resident.get(id)
+        row = await asyncio.get_running_loop().run_in_executor(None, self.fetch, id, convo.version if convo is not None else None)
+        return self.adopt(id, row)
+
+    def adopt(self, id, row: Optional[Tuple[int, bytes]]) -> Optional['ConversationModel']:
+        """The resident conversation `id`, or the fetched `row` if that is newer."""
+        convo = self.resident.get(id)
+        if row is not None and (convo is None or row[0] > convo.version):
+            self.misses += 1
+            if convo is None:
+                self.rehydrations += 1
+            convo = ConversationModel.from_dict(pickle.loads(row[1]))
+            self.remember(convo, len(row[1]))
+        elif convo is not None:
+            self.hits += 1
+            self.remember(convo)
+        return convo
+
+    def load(self, id) -> Optional['ConversationModel']:
+        self.forget(id)
+        return self.adopt(id, self.fetch(id))
+
+    def dump(self, convo: 'ConversationModel') -> Tuple[str, int, bytes]:
+        convo.version += 1
+        convo.dirty = False
+        return convo.id, convo.version, pickle.dumps(convo.to_dict())
+
+    def write(self, id: str, version: int, state: bytes) -> bool:
+        """Store `state` unless a version as new or newer is already stored; True if it was."""
+        with self.connect() as db:
+            cursor = db.execute(
+                "INSERT INTO conversations (id, version, state, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET version = excluded.version, state = excluded.state, updated = excluded.updated "
+                "WHERE excluded.version > conversations.version",
+                (id, version, state, time.time()),
+            )
+            return cursor.rowcount > 0
+
+    def written(self, convo: 'ConversationModel', state: bytes, ok: bool):
+        if not ok:
+            # another process saved this conversation from the same or a later version
+            self.forget(convo.id)
+            raise ConversationConflict(f"Conversation {convo.id} was changed elsewhere; reload it and try again")
+        self.remember(convo, len(state))
+
+    def save(self, convo: 'ConversationModel'):
+        id, version, state = self.dump(convo)
+        self.written(convo, state, self.write(id, version, state))
+
+    async def save_async(self, convo: 'ConversationModel'):
+        """Snapshot on the loop, write on a thread."""
+        id, version, state = self.dump(convo)
+        ok = await asyncio.get_running_loop().run_in_executor(None, self.write, id, version, state)
+        self.written(convo, state, ok)
+
+
+conversations = ConversationStore()
 
 class ConversationRound:
     def __init__(
         self,
         conversation: 'ConversationModel',
         user_prompt: str = DEFAULT_USER_PROMPT,
+        attachments: Optional[List[str]] = None,
+        timeout: Optional[float] = None,
+        cancel_on_error: bool = True,
     ):
         self.conversation = conversation
         self.conversation_id = conversation.id
         self.agents = conversation.agents
         self.responses: Dict[Agent, str] = defaultdict(str)
         self.user_prompt = user_prompt
-
-    @property
-    def i(self) -> int:
-        return self.conversation.rounds.index(self)
+        self.attachments = attachments or []
+        self.timeout = timeout
+        self.cancel_on_error = cancel_on_error
+        self.merge_order: List[str] = []
+        self.cancelled = False
+        self.cancelled_agents: List[Agent] = []
+        self.i = len(conversation.rounds)
+        # where this round's history ends in the conversation log, how many commits
+        # that covers, and the log's last message at that point; pinned on first use
+        self.offset: Optional[int] = None
+        self.prior_commits: Optional[int] = None
+        self.boundary: Optional[Message] = None
+        self.committed = False
+        self.token_counts: Dict[str, int] = {}
+        self.summary: Optional[str] = None
+        self.summary_task: Optional[asyncio.Future] = None
 
     @property
     def num(self) -> int:
@@ -37,28 +223,46 @@ class ConversationRound:
             posd[agent.position].append(agent)
         return [agents for pos, agents in sorted(posd.items())]
 
-    # # @property
-    # # def prompt(self) -> Message:
-    # #     return Message(role='user', content=self.user_prompt)
+    @cached_property
+    def user_message(self) -> Optional[Message]:
+        if self.user_prompt:
+            return Message(role="user", content=self.user_prompt, attachments=self.attachments)
 
-    
+    def pin_history(self):
+        if self.offset is None:
+            log = self.conversation.log
+            self.offset, self.prior_commits = len(log), len(self.conversation.commits)
+            self.boundary = log[-1] if len(log) else None
+
+    @property
+    def history(self) -> MessageLogView:
+        """Messages of the earlier rounds: a view of the shared conversation log."""
+        self.pin_history()
+        return MessageLogView(self.conversation.log, self.offset, last=self.boundary)
 
     @property
-    def messages(self) -> MessageList:
-        messages = MessageList([msg for round in self.previous for msg in round.messages])
-        if self.user_prompt: 
-            messages.add_user_message(self.user_prompt)
-        
-        # responses?
-        # responses = []
-        # for agent,response in sorted(self.responses.items(), key=lambda ar: ar[0].position):
-        #     responses.append(response)
-        # if responses:
-        #     messages.add_user_message("\n\n\n\n".join(responses))
-        for agent,response in sorted(self.responses.items(), key=lambda ar: ar[0].position):
+    def own_messages(self) -> List[Message]:
+        messages = MessageList()
+        if self.user_message is not None:
+            messages.append(self.user_message)
+        for agent, response in sorted(self.responses.items(), key=lambda ar: ar[0].position):
             messages.add_agent_message(agent, response)
+        return messages.data
 
-        return messages
+    @property
+    def messages(self) -> MessageLogView:
+        self.pin_history()
+        return MessageLogView(self.conversation.log, self.offset, self.own_messages, last=self.boundary)
+
+    def commit(self):
+        """Append this round's messages to the conversation log, once. Rounds that
+        finish, or are cancelled without "discard", are committed; failed ones are not."""
+        if self.committed:
+            return
+        self.pin_history()  # before the log grows
+        extend_messages(self.conversation.log, self.own_messages)
+        self.conversation.commits.append(self)
+        self.committed = True
 
     async def run_async(self) -> AsyncGenerator[Dict[str, Any], None]:
         token_num = 0
@@ -73,35 +277,83 @@ class ConversationRound:
                 conversation=self.conversation_id,
             )
 
-        for agents in self.agents_in_position:
-            prompt_now = self.messages
-            agent_tasks = [self.run_agent_async(agent, prompt_now) for agent in agents]
+        self.conversation.active += 1
+        self.conversation.dirty = True
+        try:
+            for agents in self.agents_in_position:
+                prompts = await asyncio.gather(*[self.conversation.context.fit(self, agent) for agent in agents])
+                agent_streams = [self.run_agent_async(agent, prompt) for agent, prompt in zip(agents, prompts)]
+                timeouts = [agent.timeout or self.timeout for agent in agents]
+                async for i, token_data in merge_async_generators(
+                    agent_streams, timeouts=timeouts, cancel_on_error=self.cancel_on_error
+                ):
+                    self.merge_order.append(agents[i].name)
+                    yield token_data
+        finally:
+            self.conversation.active -= 1
 
-            async def merge_generators(generators):
-                while generators:
-                    for gen in generators.copy():
-                        try:
-                            yield await gen.__anext__()
-                        except StopAsyncIteration:
-                            generators.remove(gen)
-
-            async for token_data in merge_generators(agent_tasks):
-                yield token_data
+        self.commit()
+        self.conversation.context.schedule(self.conversation)
+        await conversations.save_async(self.conversation)
 
     async def run_agent_async(self, agent: Agent, prompt_now: MessageList) -> AsyncGenerator[Dict[str, Any], None]:
         self.responses[agent] = ""
         token_num = 0
-        async for token in agent.generate_async(prompt_now):
-            token_num += 1
-            self.responses[agent] += token
-            yield dict(
-                round=self.num,
-                position=agent.position,
-                agent=agent.name,
-                token_num=token_num,
-                token=token,
-                conversation=self.conversation_id,
-            )
+        try:
+            async for token in agent.generate_async(prompt_now):
+                token_num += 1
+                self.responses[agent] += token
+                yield dict(
+                    round=self.num,
+                    position=agent.position,
+                    agent=agent.name,
+                    token_num=token_num,
+                    token=token,
+                    conversation=self.conversation_id,
+                )
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled_agents.append(agent)
+            raise
+
+    def mark_cancelled(self, policy: str = DEFAULT_PARTIAL_OUTPUT_POLICY):
+        """Mark the round as cancelled mid-stream; "persist" keeps the partial responses
+        in the conversation history, "discard" drops the round altogether."""
+        self.cancelled = True
+        self.conversation.dirty = True
+        if policy == "discard":
+            self.conversation.remove_round(self)
+        else:
+            self.commit()
+
+    def cancel(self, policy: str = DEFAULT_PARTIAL_OUTPUT_POLICY):
+        self.mark_cancelled(policy)
+        conversations.save(self.conversation)
+
+    async def cancel_async(self, policy: str = DEFAULT_PARTIAL_OUTPUT_POLICY):
+        """Like `cancel`, with the save written on a thread."""
+        self.mark_cancelled(policy)
+        await conversations.save_async(self.conversation)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_prompt": self.user_prompt,
+            "attachments": self.attachments,
+            "cancelled": self.cancelled,
+            "committed": self.committed,
+            "summary": self.summary,
+            "responses": [(agent.name, agent.position, response) for agent, response in self.responses.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, conversation: 'ConversationModel', d: Dict[str, Any]) -> 'ConversationRound':
+        round = cls(conversation, user_prompt=d["user_prompt"], attachments=d["attachments"])
+        round.cancelled = d["cancelled"]
+        round.summary = d.get("summary")
+        agents = {(agent.name, agent.position): agent for agent in conversation.agents}
+        for name, position, response in d["responses"]:
+            if (name, position) in agents:
+                round.responses[agents[name, position]] = response
+        return round
 
     def run_iter(self) -> Iterator[Dict[str, Any]]:
         return run_async(self.run_async)
@@ -119,14 +371,79 @@ class ConversationRound:
         return odf.sort_index()
 
 class ConversationModel:
-    def __init__(self, id: Optional[str] = None, agents: Optional[List[Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]]] = None):
+    def __init__(
+        self,
+        id: Optional[str] = None,
+        agents: Optional[List[Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]]] = None,
+        context: Optional[ContextManager] = None,
+    ):
         self.id = id or str(uuid.uuid4())
         self.rounds: List[ConversationRound] = []
         self.agents = parse_agents_list(agents or [])
+        self.context = context or ContextManager()
+        # append-only history of finished rounds, which later rounds slice into
+        self.log = MessageList()
+        # rounds in the order their messages entered the log
+        self.commits: List[ConversationRound] = []
+        self.version = 0
+        # unsaved changes, and rounds currently running; only clean, idle conversations are evicted as-is
+        self.dirty = True
+        self.active = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "version": self.version,
+            "agents": [agent.config for agent in self.agents],
+            "rounds": [round.to_dict() for round in self.rounds],
+            "commits": [self.rounds.index(round) for round in self.commits],
+        }
 
-    def add_round(self, user_prompt = DEFAULT_USER_PROMPT) -> ConversationRound:
-        round = ConversationRound(user_prompt=user_prompt, conversation=self)
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'ConversationModel':
+        convo = cls(id=d["id"])
+        # configs of already parsed agents, with their positions
+        convo.agents = [agent_from_config(config) for config in d["agents"]]
+        convo.version = d["version"]
+        for round_d in d["rounds"]:
+            convo.rounds.append(ConversationRound.from_dict(convo, round_d))
+        # replay commits as the live conversation made them (older states: every round, in order)
+        for k in d.get("commits", range(len(convo.rounds))):
+            convo.rounds[k].commit()
+        convo.dirty = False
+        return convo
+
+    def remove_round(self, round: ConversationRound):
+        """Drop a round, renumbering the rest; if its messages were already in the
+        log, rebuild the log and move every pinned offset to match."""
+        if round not in self.rounds:
+            return
+        self.rounds.remove(round)
+        for k, r in enumerate(self.rounds):
+            r.i = k
+        if round in self.commits:
+            j = self.commits.index(round)
+            self.commits.remove(round)
+            for r in self.rounds:
+                if r.prior_commits is not None and r.prior_commits > j:
+                    r.prior_commits -= 1
+            self.rebuild_log()
+
+    def rebuild_log(self):
+        self.log = MessageList()
+        ends, boundaries = [0], [None]
+        for r in self.commits:
+            extend_messages(self.log, r.own_messages)
+            ends.append(len(self.log))
+            boundaries.append(self.log[-1] if len(self.log) else None)
+        for r in self.rounds:
+            if r.prior_commits is not None:
+                r.offset, r.boundary = ends[r.prior_commits], boundaries[r.prior_commits]
+
+    def add_round(self, user_prompt = DEFAULT_USER_PROMPT, **kwargs) -> ConversationRound:
+        round = ConversationRound(user_prompt=user_prompt, conversation=self, **kwargs)
         self.rounds.append(round)
+        self.dirty = True
         return round
 
     def run(self, return_df: bool = True, by_token: bool = False) -> Union[List[Dict[str, Any]], pd.DataFrame]:
@@ -139,12 +456,19 @@ class ConversationModel:
             return pd.concat(o) if len(o) else pd.DataFrame()
 
 def Conversation(id: Optional[str] = None, agents: Optional[List[Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]]] = None) -> ConversationModel:
-    if id in conversations:
-        return conversations[id]
-    else:
+    convo = conversations.get(id)
+    if convo is None:
         convo = ConversationModel(id=id, agents=agents)
         conversations[convo.id] = convo
-        return convo
+    return convo
+
+async def Conversation_async(id: Optional[str] = None, agents: Optional[List[Union[str, Dict[str, Any], List[Union[str, Dict[str, Any]]]]]] = None) -> ConversationModel:
+    """Like `Conversation`, with the store lookup on a thread."""
+    convo = await conversations.get_async(id)
+    if convo is None:
+        convo = ConversationModel(id=id, agents=agents)
+        conversations[convo.id] = convo
+    return convo
 
 def detokenize_convo_df(df: pd.DataFrame) -> pd.DataFrame:
     gby = ['conversation', 'round', 'position', 'agent']
@@ -11,8 +11,10 @@ from threading import Thread
 import logging
 import json
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, deque, Counter, OrderedDict
 import threading
+import time
+import math
 import queue
 import warnings
 import pandas as pd
@@ -50,11 +52,15 @@ from tqdm.auto import tqdm
 import re
 import tempfile
 import shutil
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
+from types import SimpleNamespace
 from abc import ABC, abstractmethod
 import fnmatch
 from functools import cached_property
 import argparse
+import codecs
+import pickle
+import sqlite3
 
 logger = logging.getLogger(__name__)
 
@@ -133,6 +139,17 @@ MODEL_DICT = {
 
 
 DEFAULT_MAX_TOKENS = 1024
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Per-provider defaults live on the BaseLLM subclasses (`rate_limits`), and one limiter
+# is shared by every model of a provider and API key; override per model here, e.g.
+# RATE_LIMITS["gpt-4o"] = {"requests_per_minute": 500, "tokens_per_minute": 30000, "max_concurrency": 16}
+DEFAULT_RATE_LIMITS = {"max_concurrency": 16, "max_retries": 5}
+RATE_LIMITS: Dict[str, Dict[str, Any]] = {}
+
+# Logical model name -> deployments (model strings or {"model", "api_key", "api_base"} dicts)
+# for the latency-aware router behind LLM(); entries in models.json with "deployments" are merged in.
+MODEL_ROUTES: Dict[str, List[Union[str, Dict[str, Any]]]] = {}
 
 
 DEFAULT_MODELS = [
@@ -163,12 +180,34 @@ DEFAULT_SUMMARY_SYSTEM_PROMPT = "You are a senior developer reviewing parallel s
 DEFAULT_SUMMARY_USER_PROMPT = "Synthesize and summarize these suggested changes, and return a markdown representation of a directory structure of files necessary to change, along with the full functions or code snippets changed under a markdown heading for the filepath under which they appear."
 DEFAULT_INCL_REPO = False
 
+# Context-window management for long conversations
+CONTEXT_KEEP_ROUNDS = 2
+CONTEXT_SUMMARIZE_AT = 0.5
+CONTEXT_SUMMARY_MAX_TOKENS = 512
+CONTEXT_SUMMARY_SYSTEM_PROMPT = "Summarize this exchange from a longer conversation so that it can stand in for the original. Keep decisions, requirements, code identifiers, file names and open questions; drop pleasantries and repetition."
+
 DEFAULT_AGENT_NAME = 'AI'
 
+# What happens to a conversation round whose streams are cancelled (client gone or "stop"):
+# "persist" keeps the partial responses in the history, "discard" drops the round
+DEFAULT_PARTIAL_OUTPUT_POLICY = "persist"
 
-PATH_HOMEDIR = os.path.expanduser("~/.multiprompt")
+# Admission control for the converse server
+SERVER_MAX_ACTIVE_RUNS = 16
+SERVER_MAX_ACTIVE_RUNS_PER_CLIENT = 2
+SERVER_MAX_QUEUE_WAIT = 30.0
+SERVER_MAX_QUEUED_RUNS = 256
+SERVER_HOST = "localhost"
+SERVER_PORT = 8989
+SERVER_WORKERS = 1
+
+
+PATH_HOMEDIR = os.getenv("MULTIPROMPT_HOME") or os.path.expanduser("~/.multiprompt")
 PATH_DATA = os.path.join(PATH_HOMEDIR, "data")
 PATH_LLM_CACHE = os.path.join(PATH_DATA, "cache.multiprompt_llm_cache.sqlitedict")
+PATH_CONVERSATIONS = os.path.join(PATH_DATA, "conversations.sqlite")
+PATH_REPO_SNAPSHOTS = os.path.join(PATH_DATA, "repo_snapshots.sqlite")
+CONVERSATION_STORE_MAX_BYTES = 256 * 1024**2
 os.makedirs(PATH_DATA, exist_ok=True)
 
 PATH_REPO = os.path.dirname(os.path.dirname(__file__))
@@ -177,6 +216,21 @@ PATH_SRC_DATA = os.path.join(PATH_SRC, "data")
 PATH_AGENTS_JSON = os.path.join(PATH_SRC_DATA, "agents.json")
 PATH_MODELS_JSON = os.path.join(PATH_SRC_DATA, "models.json")
 
+# repo2llm ingestion: threads reading files (None: Python's default), and whether
+# comment stripping and token counting run on a process pool
+REPO2LLM_MAX_WORKERS = None
+REPO2LLM_PROCESSES = False
+# incremental snapshots of processed files; bump the format when processing changes
+REPO2LLM_SNAPSHOT = True
+REPO2LLM_SNAPSHOT_FORMAT = 1
+# `copy --watch`: seconds of quiet before regenerating, and the polling interval
+# used when watchdog is not installed
+REPO2LLM_WATCH_DEBOUNCE = 0.3
+REPO2LLM_WATCH_POLL_INTERVAL = 1.0
+# file sections held in memory while the directory tree is worked out; past this they
+# spill to a temporary file
+REPO2LLM_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
 REPO2LLM_EXTENSIONS = [
     ".py",
     ".js",
@@ -194,5 +248,14 @@ REPO2LLM_EXTENSIONS = [
 
 
 from hashstash import HashStash, serialize, progress_bar, stuff, unstuff, deserialize
+from .stashes import CachedStash, LRUCache, StashWriter, stash_set_later
 PATH_STASH = os.path.join(PATH_DATA, "stash")
-STASH = stash = HashStash(PATH_STASH, append_mode=True)
+STASH_CACHE_MAX_BYTES = 64 * 1024**2
+ATTACHMENT_CACHE_MAX_BYTES = 128 * 1024**2
+ATTACHMENT_MMAP_THRESHOLD = 1024**2
+PATH_IMAGE_CACHE = os.path.join(PATH_DATA, "images")
+# longest side in pixels for image attachments; providers override per model
+DEFAULT_IMAGE_MAX_SIZE = 2048
+IMAGE_FORMAT = "WEBP"
+IMAGE_QUALITY = 85
+STASH = stash = CachedStash(HashStash(PATH_STASH, append_mode=True), max_bytes=STASH_CACHE_MAX_BYTES)
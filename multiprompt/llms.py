@@ -1,35 +1,139 @@
 from . import *
-# from litellm import Router
 
-# def get_model_list():
-#     with open(PATH_MODELS_JSON, "r") as f:
-#         model_list = json.load(f)
-#     return [{
-#         'model_name': model['name'],
-#         'litellm_params': {
-#             'model': model['model'],
-#             'timeout': 300,
-#             'stream_timeout': 300
-#         }
-#     } for model in model_list]
 
-# model_list = get_model_list()
+class LatencyStats:
+    """Rolling time-to-first-token and throughput for one model deployment."""
 
-# router = Router(
-#     model_list=model_list,
-#     timeout=300,
-#     routing_strategy="least-busy"
-# )
+    def __init__(self, window: int = 50, max_failures: int = 3, cooldown: float = 30.0):
+        self.ttfts: Deque[float] = deque(maxlen=window)
+        self.rates: Deque[float] = deque(maxlen=window)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.failed_at = 0.0
+
+    def record(self, ttft: float, num_tokens: int, duration: float):
+        self.ttfts.append(ttft)
+        if num_tokens > 1 and duration > ttft:
+            self.rates.append((num_tokens - 1) / (duration - ttft))
+        self.failures = 0
+
+    def record_slow(self, elapsed: float):
+        # cancelled before its first token: elapsed is a lower bound on its ttft
+        self.ttfts.append(elapsed)
+
+    def record_error(self):
+        self.failures += 1
+        self.failed_at = time.monotonic()
+
+    @staticmethod
+    def quantile(values, q: float) -> Optional[float]:
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    @property
+    def ttft_p50(self) -> Optional[float]:
+        return self.quantile(self.ttfts, 0.5)
+
+    @property
+    def ttft_p95(self) -> Optional[float]:
+        return self.quantile(self.ttfts, 0.95)
+
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        return self.quantile(self.rates, 0.5)
+
+    @property
+    def healthy(self) -> bool:
+        return self.failures < self.max_failures or time.monotonic() - self.failed_at > self.cooldown
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttft_p50": self.ttft_p50,
+            "ttft_p95": self.ttft_p95,
+            "tokens_per_sec": self.tokens_per_sec,
+            "failures": self.failures,
+            "healthy": self.healthy,
+        }
+
+
+class UsageStats:
+    """Prompt, completion and cached prompt tokens reported by a provider, per call and in total."""
+
+    def __init__(self, window: int = 100):
+        self.calls: Deque[Dict[str, int]] = deque(maxlen=window)
+        self.totals: Counter = Counter()
+
+    @staticmethod
+    def field(obj, *names) -> int:
+        for name in names:
+            value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+            if value:
+                return value
+        return 0
+
+    def record(self, model: str, usage) -> Dict[str, int]:
+        details = self.field(usage, "prompt_tokens_details")
+        call = {
+            "prompt_tokens": self.field(usage, "prompt_tokens"),
+            "completion_tokens": self.field(usage, "completion_tokens"),
+            "cached_tokens": self.field(details, "cached_tokens") or self.field(usage, "cache_read_input_tokens"),
+            "cache_write_tokens": self.field(usage, "cache_creation_input_tokens"),
+        }
+        self.calls.append(call)
+        self.totals.update(call)
+        self.totals["calls"] += 1
+        logger.debug(f"{model}: {call['prompt_tokens']} prompt tokens, {call['cached_tokens']} cached, {call['cache_write_tokens']} written to cache")
+        return call
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        prompt_tokens = self.totals["prompt_tokens"]
+        return {
+            **{k: self.totals[k] for k in ["calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cache_write_tokens"]},
+            "cache_hit_rate": self.totals["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+        }
 
 
 class BaseLLM(ABC):
     badprefixes = []
     api_key = None
+    api_base = None
+    rate_limits: Dict[str, Any] = {}
+    # shared RateLimiters, by `limiter_key`
+    limiters: Dict[Hashable, RateLimiter] = {}
+    # provider-side prompt caching: how many cache_control markers to place, and
+    # whether the provider reports usage (incl. cached tokens) at the end of a stream
+    cache_breakpoints = 0
+    stream_usage = False
+    # longest side, in pixels, of image attachments sent to this model
+    max_image_size = DEFAULT_IMAGE_MAX_SIZE
 
-    def __init__(self, model: str, api_key: Optional[str] = None):
+    def __init__(self, model: str, api_key: Optional[str] = None, api_base: Optional[str] = None):
         self.model = model
         if api_key:
             self.api_key = api_key
+        if api_base:
+            self.api_base = api_base
+        self.latency = LatencyStats()
+        self.usage = UsageStats()
+        self.limiter = self.get_limiter()
+
+    @property
+    def limiter_key(self) -> Hashable:
+        # a model with its own RATE_LIMITS entry gets its own limiter
+        return (self.__class__.__name__, self.api_key, self.api_base, self.model if self.model in RATE_LIMITS else None)
+
+    def get_limiter(self) -> RateLimiter:
+        """The limiter shared by every model of this provider and key; provider limits
+        apply per account, not per model."""
+        key = self.limiter_key
+        if key not in BaseLLM.limiters:
+            BaseLLM.limiters[key] = RateLimiter(**{**DEFAULT_RATE_LIMITS, **self.rate_limits, **RATE_LIMITS.get(self.model, {})})
+        return BaseLLM.limiters[key]
 
     @staticmethod
     def format_messages(user_prompt: Union[str, 'MessageList'], system_prompt: str = "") -> 'MessageList':
@@ -41,6 +145,25 @@ class BaseLLM(ABC):
         messages.add_user_message(user_prompt)
         return messages
 
+    def format_payload(self, messages: Union['MessageList', List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        if not isinstance(messages, MessageList):
+            messages = MessageList(list(messages))
+        return messages.to_payload(cache_breakpoints=self.cache_breakpoints, max_image_size=self.max_image_size)
+
+    @staticmethod
+    def estimate_tokens(messages: 'MessageList', max_tokens: int = 0) -> int:
+        # rough prompt size (~4 characters per token) plus the completion budget
+        num_chars = 0
+        for msg in messages:
+            content = msg.get("content", "")
+            if isinstance(content, list):
+                content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+            num_chars += len(str(content))
+        return num_chars // 4 + (max_tokens or 0)
+
+    async def completion_async(self, **params):
+        return await acompletion(**params)
+
     async def generate_async(
         self,
         messages: 'MessageList',
@@ -49,55 +172,336 @@ class BaseLLM(ABC):
         verbose: bool = DEFAULT_AGENT_VERBOSE,
         **kwargs,
     ) -> AsyncGenerator[str, None]:
-        try:
-            response = await acompletion(
-                model=self.model,
-                messages = messages,
-                max_tokens = max_tokens,
-                temperature = temperature,
-                api_key=self.api_key,
-                stream=True,
-                timeout=300,
-            )
-            async for chunk in response:
-                token = chunk.choices[0].delta.content
-                if token:
-                    yield token
-                    if verbose:
-                        print(token, end="", flush=True, file=sys.stderr)
-        except Exception as e:
-            logger.error(f"Error in generate_async: {str(e)}")
-            raise
+        payload = self.format_payload(messages)
+        num_tokens = self.estimate_tokens(payload, max_tokens)
+        attempt = 0
+        while True:
+            await self.limiter.acquire(num_tokens)
+            started = False
+            sent_at = time.monotonic()
+            ttft, num_streamed = None, 0
+            response = None
+            try:
+                response = await self.completion_async(
+                    model=self.model,
+                    messages = payload,
+                    max_tokens = max_tokens,
+                    temperature = temperature,
+                    api_key=self.api_key,
+                    stream=True,
+                    timeout=300,
+                    **({"api_base": self.api_base} if self.api_base else {}),
+                    **({"stream_options": {"include_usage": True}} if self.stream_usage else {}),
+                )
+                async for chunk in response:
+                    if getattr(chunk, "usage", None):
+                        self.usage.record(self.model, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    token = chunk.choices[0].delta.content
+                    if token:
+                        if ttft is None:
+                            ttft = time.monotonic() - sent_at
+                        num_streamed += 1
+                        started = True
+                        yield token
+                        if verbose:
+                            print(token, end="", flush=True, file=sys.stderr)
+                duration = time.monotonic() - sent_at
+                self.latency.record(duration if ttft is None else ttft, num_streamed, duration)
+                return
+            except Exception as e:
+                self.latency.record_error()
+                if not started and is_rate_limit_error(e) and attempt < self.limiter.max_retries:
+                    delay = self.limiter.backoff(attempt)
+                    attempt += 1
+                    logger.warning(f"Rate limited by {self.model}, retrying in {delay:.1f}s ({attempt}/{self.limiter.max_retries})")
+                    continue
+                logger.error(f"Error in generate_async: {str(e)}")
+                raise
+            finally:
+                self.limiter.release()
+                # close the provider stream promptly when the consumer stops early
+                if response is not None and hasattr(response, "aclose"):
+                    try:
+                        await response.aclose()
+                    except Exception:
+                        pass
 
     
 
 class AnthropicLLM(BaseLLM):
     api_key = ANTHROPIC_API_KEY
+    rate_limits = {"requests_per_minute": 50, "max_concurrency": 8}
+    cache_breakpoints = MAX_CACHE_BREAKPOINTS
+    stream_usage = True
+    max_image_size = 1568
 
 
 class OpenAILLM(BaseLLM):
     api_key = OPENAI_API_KEY
+    rate_limits = {"requests_per_minute": 500, "max_concurrency": 16}
+    # prefixes are cached automatically; a stable payload layout is all it needs
+    stream_usage = True
     # Implement OpenAI-specific generate_async method
 
 
 class GeminiLLM(BaseLLM):
     api_key = GEMINI_API_KEY
+    rate_limits = {"requests_per_minute": 60, "max_concurrency": 8}
+    max_image_size = 3072
     # Implement Gemini-specific generate_async method
 
 
 class LlamaLLM(BaseLLM):
     badprefixes = ["### System:"]
+    # a local server: bound concurrency rather than rate
+    rate_limits = {"max_concurrency": 2}
     # Implement Llama-specific generate_async method
 
-@cache
-def LLM(model: str) -> BaseLLM:
-    if model.startswith("claude"):
-        return AnthropicLLM(model)
+class MockLLMError(Exception):
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MockLLM(BaseLLM):
+    """Offline stand-in provider streaming deterministic tokens, selected with `mock/...` models.
+
+    Settings come from keyword arguments or the model's query string, e.g.
+    `mock/fast?ttft=0.05&delay=0.005&tokens=200&error_rate=0.01&seed=1`. The same
+    messages always produce the same tokens; errors follow a seeded sequence.
+
+    Like Anthropic, it honours up to `cache_breakpoints` cache_control markers: a
+    marked prefix seen before is reported as cached tokens in the final usage chunk.
+    """
+
+    vocabulary = (
+        "the a of to and in that is for it with as on be this by are from or at which "
+        "model prompt agent token stream round answer code file function result"
+    ).split()
+    defaults = {
+        "ttft": 0.0,
+        "delay": 0.0,
+        "tokens": 32,
+        "error_rate": 0.0,
+        "error_status": 500,
+        "seed": 0,
+        "cache_breakpoints": MAX_CACHE_BREAKPOINTS,
+    }
+    stream_usage = True
+
+    @property
+    def limiter_key(self) -> Hashable:
+        # each simulated model is its own provider
+        return (self.__class__.__name__, self.model)
+
+    def __init__(self, model: str, api_key: Optional[str] = None, api_base: Optional[str] = None, **settings):
+        super().__init__(model, api_key=api_key, api_base=api_base)
+        query = {k: v[-1] for k, v in parse_qs(urlparse(model).query).items()}
+        for key, default in self.defaults.items():
+            value = settings.get(key, query.get(key, default))
+            setattr(self, key, type(default)(value))
+        self.rng = random.Random(self.seed)
+        self.num_requests = 0
+        self.requests: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self.cached_prefixes: Set[str] = set()
+
+    def prompt_usage(self, messages) -> Dict[str, int]:
+        """Simulated prompt caching: walk the payload, hashing the prefix so far, and
+        count the longest marked prefix already cached as read, the rest as written."""
+        prefix = hashlib.sha256()
+        num_chars = cached_chars = written_chars = 0
+        for msg in messages:
+            content = msg["content"]
+            parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+            prefix.update(msg["role"].encode())
+            for part in parts:
+                prefix.update(json.dumps({k: v for k, v in part.items() if k != "cache_control"}, sort_keys=True).encode())
+                num_chars += len(part.get("text", ""))
+                if "cache_control" in part:
+                    key = prefix.hexdigest()
+                    if key in self.cached_prefixes:
+                        cached_chars = num_chars
+                    else:
+                        written_chars = num_chars - cached_chars
+                        self.cached_prefixes.add(key)
+        return {
+            "prompt_tokens": num_chars // 4,
+            "cache_read_input_tokens": cached_chars // 4,
+            "cache_creation_input_tokens": written_chars // 4,
+        }
+
+    def response_tokens(self, messages, max_tokens: Optional[int] = None) -> List[str]:
+        digest = hashlib.sha256(json.dumps([self.seed, list(messages)], default=str).encode()).hexdigest()
+        rng = random.Random(digest)
+        num_tokens = min(self.tokens, max_tokens or self.tokens)
+        return [rng.choice(self.vocabulary) + " " for _ in range(num_tokens)]
+
+    async def completion_async(self, messages=None, max_tokens: Optional[int] = None, stream_options=None, **params):
+        self.num_requests += 1
+        self.requests.append({"messages": messages, "max_tokens": max_tokens, **params})
+        tokens = self.response_tokens(messages, max_tokens)
+        failed = self.error_rate and self.rng.random() < self.error_rate
+        usage = {**self.prompt_usage(messages), "completion_tokens": len(tokens)}
+
+        async def stream():
+            if self.ttft:
+                await asyncio.sleep(self.ttft)
+            if failed:
+                raise MockLLMError(f"Mock error from {self.model}", status_code=self.error_status)
+            for i, token in enumerate(tokens):
+                if i and self.delay:
+                    await asyncio.sleep(self.delay)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+            if stream_options and stream_options.get("include_usage"):
+                yield SimpleNamespace(choices=[], usage=usage)
+
+        return stream()
+
+
+class RouterLLM(BaseLLM):
+    """Routes a logical model name to the fastest healthy of several deployments.
+
+    If the chosen deployment has not produced a token by its rolling p95 time to first
+    token, a hedged duplicate goes to the next deployment; whichever answers first is
+    streamed and the other is cancelled. Errors before the first token fail over.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        deployments: List[Union[str, Dict[str, Any], BaseLLM]],
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.5,
+        hedge_default_delay: float = 10.0,
+    ):
+        super().__init__(model)
+        self.deployments = [get_deployment_llm(deployment) for deployment in deployments]
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.num_hedged = 0
+
+    def ranked_deployments(self) -> List[BaseLLM]:
+        pool = [llm for llm in self.deployments if llm.latency.healthy] or self.deployments
+        # deployments without samples yet rank first so they get measured
+        return sorted(pool, key=lambda llm: llm.latency.ttft_p50 or 0.0)
+
+    def hedge_delay(self, llm: BaseLLM) -> float:
+        ttft = LatencyStats.quantile(llm.latency.ttfts, self.hedge_quantile)
+        return self.hedge_default_delay if ttft is None else max(self.hedge_min_delay, ttft)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedged": self.num_hedged,
+            "deployments": {
+                llm.model: {**llm.latency.stats, **llm.limiter.stats, "usage": llm.usage.stats} for llm in self.deployments
+            },
+        }
+
+    async def generate_async(self, messages: 'MessageList', **kwargs) -> AsyncGenerator[str, None]:
+        async def first_token(stream):
+            return await stream.__anext__()
+
+        candidates = self.ranked_deployments()
+        streams, waiting, launched_at = [], {}, []
+
+        def launch():
+            llm = candidates[len(streams)]
+            stream = llm.generate_async(messages, **kwargs)
+            streams.append(stream)
+            launched_at.append(time.monotonic())
+            waiting[asyncio.ensure_future(first_token(stream))] = stream
+
+        launch()
+        deadline = self.hedge_delay(candidates[0]) if self.hedge and len(candidates) > 1 else None
+        winner, token, error = None, None, None
+        try:
+            while waiting and winner is None:
+                done, _ = await asyncio.wait(waiting, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+                deadline = None
+                if not done:
+                    logger.info(f"Hedging {self.model}: no token from {candidates[0].model}, trying {candidates[1].model}")
+                    self.num_hedged += 1
+                    launch()
+                    continue
+                for task in done:
+                    stream = waiting.pop(task)
+                    try:
+                        token = task.result()
+                    except StopAsyncIteration:
+                        token = None
+                    except Exception as e:
+                        error = e
+                        continue
+                    winner = stream
+                    break
+                if winner is None and not waiting and len(streams) < len(candidates):
+                    launch()
+        finally:
+            for task, stream in waiting.items():
+                if not task.done():
+                    task.cancel()
+                    i = streams.index(stream)
+                    candidates[i].latency.record_slow(time.monotonic() - launched_at[i])
+            await asyncio.gather(*waiting, return_exceptions=True)
+            for stream in streams:
+                if stream is not winner:
+                    await stream.aclose()
+
+        if winner is None:
+            raise error
+        try:
+            if token is not None:
+                yield token
+                async for token in winner:
+                    yield token
+        finally:
+            await winner.aclose()
+
+
+def get_deployment_llm(deployment: Union[str, Dict[str, Any], BaseLLM]) -> BaseLLM:
+    if isinstance(deployment, BaseLLM):
+        return deployment
+    if isinstance(deployment, str):
+        return LLM(deployment)
+    model = deployment["model"]
+    return get_provider_class(model)(model, api_key=deployment.get("api_key"), api_base=deployment.get("api_base"))
+
+
+def get_provider_class(model: str) -> type:
+    if model.startswith("mock/"):
+        return MockLLM
+    elif model.startswith("claude"):
+        return AnthropicLLM
     elif model.startswith("gpt"):
-        return OpenAILLM(model)
+        return OpenAILLM
     elif model.startswith("gemini"):
-        return GeminiLLM(model)
+        return GeminiLLM
     else:
-        return LlamaLLM(model)
-    
+        return LlamaLLM
+
+
+@cache
+def get_model_routes() -> Dict[str, List[Union[str, Dict[str, Any]]]]:
+    routes = {}
+    try:
+        with open(PATH_MODELS_JSON) as f:
+            for d in json.load(f):
+                if d.get("deployments"):
+                    routes[d["model"]] = d["deployments"]
+    except FileNotFoundError:
+        pass
+    return {**routes, **MODEL_ROUTES}
+
 
+@cache
+def LLM(model: str) -> BaseLLM:
+    routes = get_model_routes()
+    if model in routes:
+        return RouterLLM(model, routes[model])
+    return get_provider_class(model)(model)
@@ -1,8 +1,12 @@
 from . import *
 
+PAYLOAD_PART_KEYS = {"type", "text", "image_url"}
+CACHE_CONTROL = {"type": "ephemeral"}
+MAX_CACHE_BREAKPOINTS = 4
+
 class Message(UserDict):
-    def __init__(self, role='user', content="", attachments=[], example=None,**kwargs):
-        content = self.process_content(content, attachments=attachments)
+    def __init__(self, role='user', content="", attachments=[], example=None, max_image_size=None, **kwargs):
+        content = self.process_content(content, attachments=attachments, max_image_size=max_image_size)
         super().__init__(role=role, content=content)
         if example is not None:
             self['example'] = example
@@ -13,7 +17,7 @@ class Message(UserDict):
         return {k:v for k,v in {
             'role': self.role,
             'content': self.text,
-            'example': self.is_example,
+            'example': self.get('example'),
             'attachments': self.attachments
         }.items() if v is not None}
     
@@ -76,8 +80,31 @@ class Message(UserDict):
     def get_attachments(self):
         return self.get('attachments',[])
 
+    def payload_parts(self, max_image_size: Optional[int] = None) -> List[dict]:
+        """Content parts as sent to a provider, in order and without our own bookkeeping
+        keys. Image attachments are re-fetched at `max_image_size` if given."""
+        if isinstance(self.content, str):
+            return [{"type": "text", "text": self.content}]
+        parts = self.content
+        if max_image_size:
+            parts = [self.resize_image_part(part, max_image_size) for part in parts]
+        return [{k: v for k, v in part.items() if k in PAYLOAD_PART_KEYS} for part in parts]
+
+    @staticmethod
+    def resize_image_part(part: dict, max_image_size: int) -> dict:
+        if part.get("type") != "image_url" or "attachment" not in part:
+            return part
+        if part.get("max_size", DEFAULT_IMAGE_MAX_SIZE) == max_image_size:
+            return part  # already encoded for this provider
+        try:
+            return ATTACHMENTS.image_part(part["attachment"], max_image_size)
+        except OSError:
+            return part
+
     @staticmethod
-    def process_content(content: Union[str, List[dict]], attachments: List[str] = []) -> List[dict]:
+    def process_content(
+        content: Union[str, List[dict]], attachments: List[str] = [], max_image_size: Optional[int] = None
+    ) -> List[dict]:
         processed_content = []
         if isinstance(content, str):
             processed_content.append({"type": "text", "text": content})
@@ -93,35 +120,26 @@ class Message(UserDict):
             appendix_txt_file_count = 0
             for attachment in attachments:
                 if Message.is_image(attachment):
-                    processed_content.append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{Message.encode_image(attachment)}"
-                            },
-                        }
-                    )
+                    processed_content.append(ATTACHMENTS.image_part(attachment, max_image_size or DEFAULT_IMAGE_MAX_SIZE))
                 elif Message.is_video(attachment):
                     # Handle video files as needed
                     pass
                 else:
                     # For text files, read and add content separately
-                    with open(attachment, "r") as file:
-                        file_content = file.read()
-                        ext = os.path.splitext(attachment)[-1].lstrip(".")
-                        processed_content.append(
-                            {
-                                "type": "text",
-                                "text": f"## Appendix to user prompt{' (continued)' if appendix_txt_file_count else ''}\n\n### Contents of file: `{Path(attachment).relative_to(common_root)}`\n\n```{ext}\n{file_content}```",
-                            }
+                    processed_content.append(
+                        ATTACHMENTS.text_part(
+                            attachment,
+                            str(Path(attachment).relative_to(common_root)),
+                            continued=bool(appendix_txt_file_count),
                         )
-                        appendix_txt_file_count += 1
+                    )
+                    appendix_txt_file_count += 1
 
         return processed_content
 
     @staticmethod
     def is_image(file_path: str) -> bool:
-        image_extensions = [".jpg", ".jpeg", ".png", ".gif", ".bmp"]
+        image_extensions = [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]
         return any(file_path.lower().endswith(ext) for ext in image_extensions)
 
     @staticmethod
@@ -131,8 +149,7 @@ class Message(UserDict):
 
     @staticmethod
     def encode_image(image_path: str) -> str:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+        return ATTACHMENTS.image_part(image_path)["image_url"]["url"].split(",", 1)[1]
 
 class MessageList(UserList):
     def __init__(self, data: List[Message] = None):
@@ -240,6 +257,7 @@ class MessageList(UserList):
         attachments: List[str] = None,
         system_prompt: str = None,
         example_prompts: List[Tuple[str, str]] = None,
+        max_image_size: Optional[int] = None,
     ):
         messages = cls()
         if system_prompt:
@@ -250,11 +268,49 @@ class MessageList(UserList):
             messages.add_user_message(
                 user_prompt,
                 attachments=attachments,
+                max_image_size=max_image_size,
             )
         return messages
 
     def to_dict(self):
         return {'messages': self.to_list()}
+
+    def to_payload(self, cache_breakpoints: int = 0, max_image_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Clean `{role, content}` dicts for a completion call.
+
+        With `cache_breakpoints`, up to that many content parts get Anthropic-style
+        `cache_control` markers at the ends of the stable prefixes: the system prompt,
+        the example prompts, the history before the last user message, and the last
+        user message up to its last attachment.
+        """
+        msgs = [msg if isinstance(msg, Message) else Message(role=msg["role"], content=msg["content"]) for msg in self]
+        parts = [msg.payload_parts(max_image_size) for msg in msgs]
+        last_user = max((i for i, msg in enumerate(msgs) if msg.role == "user"), default=None)
+        candidates = [
+            max((i for i, msg in enumerate(msgs) if msg.role == "system"), default=None),
+            max((i for i, msg in enumerate(msgs) if msg.is_example), default=None),
+        ]
+        marks = [(i, len(parts[i]) - 1) for i in candidates if i is not None and parts[i]]
+        if last_user is not None:
+            content = msgs[last_user].content if isinstance(msgs[last_user].content, list) else []
+            attached = [j for j, part in enumerate(content) if "attachment" in part]
+            if attached:
+                marks.append((last_user, attached[-1]))
+            if last_user > 0 and parts[last_user - 1]:
+                marks.append((last_user - 1, len(parts[last_user - 1]) - 1))
+        marks = sorted(set(marks))[:cache_breakpoints] if cache_breakpoints else []
+        for i, j in marks:
+            parts[i][j]["cache_control"] = CACHE_CONTROL
+        marked = {i for i, j in marks}
+
+        payload = []
+        for i, msg in enumerate(msgs):
+            if i in marked or any(part["type"] != "text" for part in parts[i]):
+                content = parts[i]
+            else:
+                content = "\n\n".join(part["text"] for part in parts[i])
+            payload.append({"role": msg.role, "content": content})
+        return payload
     
     def to_list(self):
         return [msg.to_dict() for msg in self]
@@ -263,8 +319,104 @@ class MessageList(UserList):
     def from_list(cls, l):
         return cls([Message.from_dict(msg) for msg in l])
     
+    @classmethod
     def from_dict(cls, d):
-        return cls(**d.get('messages',{}))
+        return cls.from_list(d.get('messages', []))
     
     def __reduce__(self):
-        return (self.__class__.from_dict, (self.to_dict(),))
\ No newline at end of file
+        return (self.__class__.from_dict, (self.to_dict(),))
+
+
+def extend_messages(messages: MessageList, new_messages: List[Message]):
+    """Append messages in place, merging into the last one when roles repeat (as `MessageList.add_message` does)."""
+    for msg in new_messages:
+        if len(messages) and messages[-1].role == msg.role:
+            messages[-1] = messages[-1] + msg
+        else:
+            messages.append(msg)
+
+
+class MessageLogView(MessageList):
+    """The first `stop` messages of a shared, append-only log followed by `tail`,
+    read in place instead of copied.
+
+    `last` is the log's message at `stop - 1` as it stood when the view's history was
+    fixed, since a later commit may have merged into it; roles repeating across the
+    seam merge as in `extend_messages`. Anything that mutates the view first gives
+    it a private copy, so the log is never changed through it.
+    """
+
+    def __init__(
+        self,
+        log: MessageList,
+        stop: int,
+        tail: Sequence[Message] = (),
+        last: Optional[Message] = None,
+    ):
+        self.log = log
+        self.stop = stop
+        self.head: List[Message] = []
+        last = last if last is not None or not stop else log[stop - 1]
+        tail = list(tail)
+        if last is not None and tail and tail[0].role == last.role:
+            last, tail = last + tail[0], tail[1:]
+        self.last = last
+        self.tail = tail
+        self._data: Optional[List[Message]] = None
+
+    @property
+    def data(self) -> List[Message]:
+        if self._data is None:
+            self._data = list(self.iter_messages())
+        return self._data
+
+    @data.setter
+    def data(self, value: List[Message]):
+        self._data = value
+
+    def iter_messages(self) -> Iterator[Message]:
+        yield from self.head
+        if self.last is not None:
+            yield from itertools.islice(self.log.data, self.stop - 1)
+            yield self.last
+        yield from self.tail
+
+    def __iter__(self):
+        return iter(self._data) if self._data is not None else self.iter_messages()
+
+    def __len__(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return len(self.head) + (self.stop if self.last is not None else 0) + len(self.tail)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return MessageList(list(self)[i])
+        if self._data is not None:
+            return self._data[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("message index out of range")
+        if i < len(self.head):
+            return self.head[i]
+        i -= len(self.head)
+        if self.last is not None:
+            if i < self.stop - 1:
+                return self.log.data[i]
+            if i == self.stop - 1:
+                return self.last
+            i -= self.stop
+        return self.tail[i]
+
+    def with_head(self, *messages: Message) -> "MessageLogView":
+        """The same view with `messages` (e.g. a system prompt) in front."""
+        view = object.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        view.head = list(messages) + self.head
+        view._data = None
+        return view
+
+    def __reduce__(self):
+        return (MessageList.from_list, (self.to_list(),))
@@ -1,6 +1,104 @@
 from . import *
 
 
+class InflightGeneration:
+    """One provider stream shared by every concurrent caller generating the same Prompt.key.
+
+    The stream runs in its own task; subscribers replay the tokens produced so far and
+    then follow live ones. The task is cancelled once the last subscriber leaves, and
+    the flight is closed to newcomers at that moment. Calls with different generate
+    kwargs (temperature, max_tokens, ...) never share a flight.
+    """
+
+    registry: Dict[str, "InflightGeneration"] = {}
+
+    def __init__(self, prompt: "Prompt", **kwargs):
+        self.key = prompt.key
+        self.flight_key = self.get_flight_key(prompt, **kwargs)
+        self.stash = prompt.stash
+        self.loop = asyncio.get_running_loop()
+        self.tokens: List[str] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.done = False
+        self.closed = False
+        self.error: Optional[BaseException] = None
+        self.task = asyncio.ensure_future(self.drive(prompt, **kwargs))
+
+    @staticmethod
+    def get_flight_key(prompt: "Prompt", **kwargs) -> str:
+        return serialize([prompt.key, sorted(kwargs.items())]) if kwargs else prompt.key
+
+    @property
+    def joinable(self) -> bool:
+        cancelling = getattr(self.task, "cancelling", None)
+        return (
+            not self.done
+            and not self.closed
+            and not (cancelling is not None and cancelling())
+            and self.loop is asyncio.get_running_loop()
+        )
+
+    @classmethod
+    def join(cls, prompt: "Prompt", **kwargs) -> "InflightGeneration":
+        flight_key = cls.get_flight_key(prompt, **kwargs)
+        flight = cls.registry.get(flight_key)
+        if flight is None or not flight.joinable:
+            flight = cls.registry[flight_key] = cls(prompt, **kwargs)
+        return flight
+
+    def close(self):
+        """Stop taking subscribers and cancel the stream."""
+        self.closed = True
+        if self.registry.get(self.flight_key) is self:
+            del self.registry[self.flight_key]
+        self.task.cancel()
+
+    async def drive(self, prompt: "Prompt", **kwargs):
+        try:
+            async for token in prompt.llm.generate_async(**prompt.params, **kwargs):
+                self.tokens.append(token)
+                for queue in self.subscribers:
+                    queue.put_nowait(token)
+            if self.stash is not None:
+                stash_set_later(self.stash, self.key, tuple(self.tokens))
+        except asyncio.CancelledError as e:
+            self.error = e
+            raise
+        except Exception as e:
+            # handed to every subscriber instead of surfacing on the task
+            self.error = e
+        finally:
+            self.done = True
+            if self.registry.get(self.flight_key) is self:
+                del self.registry[self.flight_key]
+            for queue in self.subscribers:
+                queue.put_nowait(self)
+
+    async def subscribe(self, stash=None):
+        queue = asyncio.Queue()
+        for token in self.tokens:
+            queue.put_nowait(token)
+        if self.done:
+            queue.put_nowait(self)
+        else:
+            self.subscribers.append(queue)
+        try:
+            while True:
+                token = await queue.get()
+                if token is self:
+                    break
+                yield token
+            if self.error is not None:
+                raise self.error
+            if stash is not None and stash is not self.stash:
+                stash_set_later(stash, self.key, tuple(self.tokens))
+        finally:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+                if not self.subscribers and not self.done:
+                    self.close()
+
+
 class Prompt:
     def __init__(
         self,
@@ -35,6 +133,7 @@ class Prompt:
                 attachments=attachments,
                 system_prompt=system_prompt,
                 example_prompts=example_prompts,
+                max_image_size=self.max_image_size,
             )
         else:
             self._messages = user_prompt
@@ -87,17 +186,30 @@ class Prompt:
 
     @cached_property
     def messages(self):
+        if isinstance(self.user_prompt, MessageLogView):
+            # a round's view of the conversation log: add our system prompt without copying
+            view = self.user_prompt
+            if self.system_prompt and not (len(view) and view[0].role == "system"):
+                return view.with_head(Message(role="system", content=self.system_prompt))
+            return view
+        if isinstance(self.user_prompt, MessageList):
+            # a conversation so far; it only lacks our system prompt
+            messages = MessageList(self.user_prompt)
+            if self.system_prompt and not messages.get_messages_by_role("system"):
+                messages.add_system_message(self.system_prompt)
+            return messages
         return MessageList.from_prompt(
             user_prompt=self.user_prompt,
             attachments=self.attachments,
             system_prompt=self.system_prompt,
             example_prompts=self.example_prompts,
+            max_image_size=self.max_image_size,
         )
 
     @property
     def params(self):
         return dict(
-            **self.messages.to_dict(),
+            messages=self.messages,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
             verbose=self.verbose,
@@ -107,6 +219,11 @@ class Prompt:
     def llm(self):
         return LLM(model=self.model)
 
+    @property
+    def max_image_size(self) -> Optional[int]:
+        # image attachments are encoded once, at the size this model's provider takes
+        return self.llm.max_image_size if self.attachments else None
+
     @cached_property
     def key(self, without={"verbose"}):
         return serialize({k: v for k, v in self.to_dict().items() if k not in without})
@@ -116,27 +233,30 @@ class Prompt:
         return STASH
 
     async def generate_async(self, _force=False, **kwargs):
-        if _force or not self.is_stashed:
-            l = []
-            async for token in self.llm.generate_async(**self.params, **kwargs):
+        stashed = None if _force else self.stashed_response
+        if stashed is None:
+            flight = InflightGeneration.join(self, **kwargs)
+            async for token in flight.subscribe(stash=self.stash):
                 yield token
-                l.append(token)
-            if self.stash is not None:
-                lt = tuple(l)
-                self.stash.set(self.key, lt)
         else:
-            for token in self.db.get(self.key):
+            for token in stashed:
                 yield token
 
     @property
     def is_stashed(self):
         return self.stash is not None and self.key in self.stash
 
+    @property
+    def stashed_response(self):
+        # one lookup, answered from the stash's memory tier when hot
+        return self.stash.get(self.key) if self.stash is not None else None
+
     def generate(self, _force=False, sep="", **kwargs):
-        if _force or not self.is_stashed:
+        stashed = None if _force else self.stashed_response
+        if stashed is None:
             l = run_async(self.generate_async, _force=True, **kwargs)
         else:
-            l = self.db.get(self.key)
+            l = stashed
         return self.format_response(l, sep=sep)
 
     @property
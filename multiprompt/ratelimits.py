@@ -0,0 +1,128 @@
+from .imports import *
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float = 1) -> float:
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float = 1):
+        self.refill()
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Requests/tokens per minute plus a cap on concurrent streams, served first come first served."""
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.active = 0
+        self.blocked_until = 0.0
+        self.waiters: Deque[asyncio.Event] = deque()
+        self.num_acquired = 0
+        self.num_rate_limited = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.waiters)
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.num_acquired if self.num_acquired else 0.0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "acquired": self.num_acquired,
+            "rate_limited": self.num_rate_limited,
+            "last_wait": self.last_wait,
+            "mean_wait": self.mean_wait,
+        }
+
+    def delay(self, tokens: float = 0) -> float:
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return math.inf
+        delay = max(0.0, self.blocked_until - time.monotonic())
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.delay(tokens))
+        return delay
+
+    def wake(self):
+        if self.waiters:
+            self.waiters[0].set()
+
+    async def acquire(self, tokens: float = 0):
+        started = time.monotonic()
+        event = asyncio.Event()
+        self.waiters.append(event)
+        try:
+            while True:
+                delay = self.delay(tokens) if self.waiters[0] is event else math.inf
+                if delay <= 0:
+                    break
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), None if delay == math.inf else delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiters.remove(event)
+            self.wake()
+        if self.requests is not None:
+            self.requests.consume(1)
+        if self.tokens is not None and tokens:
+            self.tokens.consume(tokens)
+        self.active += 1
+        self.num_acquired += 1
+        self.last_wait = time.monotonic() - started
+        self.total_wait += self.last_wait
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def backoff(self, attempt: int) -> float:
+        """Pause every caller for an exponentially growing, jittered delay after a rate-limit error."""
+        self.num_rate_limited += 1
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    rate_limit_error = getattr(litellm, "RateLimitError", None)
+    if rate_limit_error is not None and isinstance(e, rate_limit_error):
+        return True
+    return getattr(e, "status_code", None) == 429
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 from .imports import *
+from .utils import map_ordered
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 def remove_comments(code_contents_str, code_file_extension):
@@ -16,9 +19,256 @@ def remove_comments(code_contents_str, code_file_extension):
         return code_contents_str
     return re.sub(pattern, '', code_contents_str)
 
+def read_file_record(path: Path, full_path: Path, path_rel: str) -> Dict[str, Any]:
+    """Read one file, once: its size and its text (None if unreadable or not UTF-8)."""
+    mtime_ns = None
+    try:
+        with open(full_path, "rb") as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
+    except OSError as e:
+        logger.error(f"Unable to read {full_path}: {e}")
+        data = b""
+        text = None
+    else:
+        try:
+            text = data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        except UnicodeDecodeError:
+            logger.warning(f"Unable to read {full_path} as text. Skipping.")
+            text = None
+    return {
+        "path": path,
+        "filename": full_path.name,
+        "path_rel": path_rel,
+        "path_abs": full_path.absolute().as_posix(),
+        "filesize": len(data),
+        "mtime_ns": mtime_ns,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "text": text,
+    }
+
+
+def finish_file_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Strip comments and count tokens; CPU-bound, so it may run in another process."""
+    text = record.pop("text")
+    record["content"] = None if text is None else remove_comments(text, record["path"].suffix[1:])
+    record["num_tokens"] = 0 if record["content"] is None else len(record["content"].split())
+    return record
+
+
+def build_path_tree(paths: Iterable[str]) -> Dict[str, Any]:
+    """Nested dicts of path parts; files map to None."""
+    tree: Dict[str, Any] = {}
+    for path in paths:
+        add_to_path_tree(tree, path)
+    return tree
+
+
+def add_to_path_tree(tree: Dict[str, Any], path: str):
+    parts = Path(path).parts
+    current = tree
+    for part in parts[:-1]:
+        current = current.setdefault(part, {})
+    current[parts[-1]] = None
+
+
+def remove_from_path_tree(tree: Dict[str, Any], path: str):
+    """Remove a file, and any directories it leaves empty."""
+    parts = Path(path).parts
+    nodes = [tree]
+    for part in parts[:-1]:
+        node = nodes[-1].get(part)
+        if not node:
+            return
+        nodes.append(node)
+    nodes[-1].pop(parts[-1], None)
+    for node, part in zip(reversed(nodes[:-1]), reversed(parts[:-1])):
+        if node[part]:
+            break
+        del node[part]
+
+
+def format_path_tree(tree: Dict[str, Any], prefix: str = "") -> str:
+    lines = []
+    items = sorted(tree.items())
+    for i, (name, subtree) in enumerate(items):
+        is_last = i == len(items) - 1
+        lines.append(f"{prefix}{'└── ' if is_last else '├── '}{name}")
+        if subtree is not None:
+            lines.append(format_path_tree(subtree, prefix + ("    " if is_last else "│   ")))
+    return "\n".join(line for line in lines if line)
+
+
+class RepoSnapshot:
+    """On-disk index of a root's processed files, so repeated runs only redo what changed.
+
+    Rows are keyed by path and hold the file's mtime, size and content hash with its
+    comment-stripped content and token count. A file whose mtime and size match is
+    reused without being opened; one whose content hash still matches is reused
+    without being reprocessed. Rows for files that were deleted, or are now ignored,
+    are dropped at the end of a complete pass.
+    """
+
+    def __init__(self, root: Union[str, Path], path: str = PATH_REPO_SNAPSHOTS):
+        self.root = str(root)
+        self.path = path
+        self.local = threading.local()
+        self.reused = self.rebuilt = self.deleted = 0
+        self.seen: Set[str] = set()
+        self.updates: List[Tuple] = []
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS files (root TEXT NOT NULL, path_rel TEXT NOT NULL, format INTEGER NOT NULL, "
+                "mtime_ns INTEGER, size INTEGER, sha256 TEXT, content TEXT, num_tokens INTEGER, PRIMARY KEY (root, path_rel))"
+            )
+            rows = db.execute(
+                "SELECT path_rel, mtime_ns, size, sha256 FROM files WHERE root = ? AND format = ?",
+                (self.root, REPO2LLM_SNAPSHOT_FORMAT),
+            )
+            self.index: Dict[str, Tuple[int, int, str]] = {row[0]: tuple(row[1:]) for row in rows}
+
+    def connect(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def load(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        content, num_tokens = self.connect().execute(
+            "SELECT content, num_tokens FROM files WHERE root = ? AND path_rel = ?", (self.root, record["path_rel"])
+        ).fetchone()
+        record.pop("text", None)
+        return {**record, "content": content, "num_tokens": num_tokens, "reused": True}
+
+    def lookup(self, path: Path, full_path: Path, path_rel: str) -> Optional[Dict[str, Any]]:
+        """The cached record for an unchanged file (by mtime and size), without reading it."""
+        entry = self.index.get(path_rel)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return None
+        mtime_ns, size, sha256 = entry
+        if (st.st_mtime_ns, st.st_size) != (mtime_ns, size):
+            return None
+        record = {
+            "path": path,
+            "filename": full_path.name,
+            "path_rel": path_rel,
+            "path_abs": full_path.absolute().as_posix(),
+            "filesize": size,
+            "mtime_ns": mtime_ns,
+            "sha256": sha256,
+        }
+        return self.load(record)
+
+    def lookup_content(self, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The cached record for a file that was touched but whose content is unchanged."""
+        entry = self.index.get(record["path_rel"])
+        if entry is None or entry[2] != record["sha256"]:
+            return None
+        return {**self.load(record), "touched": True}
+
+    def observe(self, record: Dict[str, Any]):
+        self.seen.add(record["path_rel"])
+        if record.get("reused"):
+            self.reused += 1
+            if not record.get("touched"):
+                return
+        else:
+            self.rebuilt += 1
+        self.index[record["path_rel"]] = (record["mtime_ns"], record["filesize"], record["sha256"])
+        self.updates.append(
+            (self.root, record["path_rel"], REPO2LLM_SNAPSHOT_FORMAT, record["mtime_ns"], record["filesize"],
+             record["sha256"], record["content"], record["num_tokens"])
+        )
+        if len(self.updates) >= 256:
+            self.flush()
+
+    def flush(self):
+        if self.updates:
+            with self.connect() as db:
+                db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.updates)
+            self.updates = []
+
+    def finish(self):
+        """Write pending rows and drop those for files that were not seen in this pass."""
+        self.flush()
+        stale = [(self.root, path_rel) for path_rel in self.index if path_rel not in self.seen]
+        if stale:
+            with self.connect() as db:
+                db.executemany("DELETE FROM files WHERE root = ? AND path_rel = ?", stale)
+        self.deleted = len(stale)
+        logger.info(f"Snapshot of {self.root}: reused {self.reused} files, rebuilt {self.rebuilt}, dropped {self.deleted}")
+
+    def forget(self, path_rel: str):
+        """Drop the row of a file that was deleted or became ignored."""
+        if self.index.pop(path_rel, None) is not None:
+            self.flush()
+            with self.connect() as db:
+                db.execute("DELETE FROM files WHERE root = ? AND path_rel = ?", (self.root, path_rel))
+            self.deleted += 1
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"reused": self.reused, "rebuilt": self.rebuilt, "deleted": self.deleted}
+
+
+class IgnoreMatcher:
+    """IGNORE_PATHS and every .gitignore under a root, as gitignore-style patterns.
+
+    Patterns from a nested .gitignore are rebased onto its directory, so one list
+    of compiled patterns answers for any path relative to the root. Later patterns
+    win, as in git, and directories can be tested (with a trailing slash) so a walk
+    can prune them.
+    """
+
+    def __init__(self, patterns: Iterable[str] = IGNORE_PATHS):
+        from pathspec import PathSpec
+        from pathspec.patterns import GitWildMatchPattern
+        self.pattern_class = GitWildMatchPattern
+        self.patterns = [GitWildMatchPattern(pattern) for pattern in sorted(patterns)]
+        self.spec = PathSpec(self.patterns)
+        self.gitignores: List[str] = []
+
+    @staticmethod
+    def rebase(line: str, prefix: str) -> Optional[str]:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            return None
+        if not prefix:
+            return line
+        negate = "!" if line.startswith("!") else ""
+        pattern = line[len(negate):]
+        anchored = "/" in pattern.rstrip("/")
+        pattern = pattern.lstrip("/")
+        return f"{negate}{prefix}/{pattern}" if anchored else f"{negate}{prefix}/**/{pattern}"
+
+    def add_gitignore(self, path: Union[str, Path], prefix: str = ""):
+        """Add the rules of the .gitignore at `path`, which sits in the directory `prefix` (relative to the root)."""
+        with open(path, "r") as f:
+            lines = [self.rebase(line, prefix) for line in f]
+        self.patterns.extend(self.pattern_class(line) for line in lines if line is not None)
+        self.spec = self.spec.__class__(self.patterns)
+        self.gitignores.append(str(path))
+
+    def match(self, rel_path: str, is_dir: bool = False) -> bool:
+        return self.spec.match_file(rel_path + "/" if is_dir else rel_path)
+
+
 class BaseRepoReader(ABC):
-    def __init__(self, extensions=None):
+    snapshot: Optional[RepoSnapshot] = None
+
+    def __init__(self, extensions=None, max_workers: Optional[int] = REPO2LLM_MAX_WORKERS, processes: bool = REPO2LLM_PROCESSES):
         self.extensions = extensions or REPO2LLM_EXTENSIONS
+        self.ignore = IgnoreMatcher()
+        self.max_workers = max_workers
+        self.processes = processes
+
+    def new_snapshot(self) -> Optional[RepoSnapshot]:
+        return None
 
     @abstractmethod
     def get_files(self):
@@ -26,125 +276,177 @@ class BaseRepoReader(ABC):
 
     @property
     def pathdata(self):
-        def getfilesize(fn):
-            try:
-                return fn.absolute().stat().st_size
-            except Exception as e:
-                return 0
-        def getnumtokens(fn):
-            try:
-                txt=self.read_file(fn)
-                return len(txt.split())
-            except Exception as e:
-                logger.error(e)
-                return 0
-        
-        return [
-            {
-                'filename': fn.name,
-                'path_rel': fn.relative_to(self.root_dir).as_posix(),
-                'path_abs': fn.absolute().as_posix(),
-                'filesize': getfilesize(fn),
-                'num_tokens': getnumtokens(fn)
-            }
-            for fn in self.get_files()
-        ]
-                
+        keys = ["filename", "path_rel", "path_abs", "filesize", "num_tokens"]
+        return [{k: record[k] for k in keys} for record in self.records]
 
     @abstractmethod
     def read_file(self, file_path):
         pass
 
+    @abstractmethod
+    def full_path(self, file_path) -> Path:
+        pass
+
+    @contextmanager
+    def opened(self):
+        """Keeps the files readable while records are being made."""
+        yield
+
+    def iter_records(self, files: Optional[Iterable] = None) -> Iterator[Dict[str, Any]]:
+        """One record per file, in walk order: path, size, comment-stripped content
+        and token count. Files are read on a thread pool and, with `processes`,
+        stripped and counted on a process pool."""
+        snapshot = self.snapshot = self.new_snapshot()
+        with self.opened(), ThreadPoolExecutor(self.max_workers) as threads:
+            procs = ProcessPoolExecutor(self.max_workers) if self.processes else None
+
+            try:
+                for result in map_ordered(threads, lambda file_path: self.ingest(file_path, procs), self.get_files() if files is None else files):
+                    record = result.result() if isinstance(result, Future) else result
+                    if snapshot is not None:
+                        snapshot.observe(record)
+                    yield record
+                if snapshot is not None:
+                    snapshot.finish()
+            finally:
+                if procs is not None:
+                    procs.shutdown(cancel_futures=True)
+
+    def ingest(self, file_path, procs: Optional[ProcessPoolExecutor] = None) -> Union[Dict[str, Any], Future]:
+        """The record for one file, from the snapshot when it is unchanged; a Future
+        when the processing was handed to `procs`."""
+        snapshot = self.snapshot
+        full_path, path_rel = self.full_path(file_path), self.relative_path(file_path)
+        record = snapshot.lookup(file_path, full_path, path_rel) if snapshot is not None else None
+        if record is not None:
+            return record
+        record = read_file_record(file_path, full_path, path_rel)
+        cached = snapshot.lookup_content(record) if snapshot is not None else None
+        if cached is not None:
+            return cached
+        return procs.submit(finish_file_record, record) if procs is not None else finish_file_record(record)
+
+    def relative_path(self, file_path) -> str:
+        path = Path(file_path)
+        return (path.relative_to(self.root_dir) if path.is_absolute() else path).as_posix()
+
+    @cached_property
+    def records(self) -> List[Dict[str, Any]]:
+        return list(self.iter_records())
+
     def should_ignore(self, path):
-        path_parts = Path(path).parts
-        for i in range(len(path_parts)):
-            partial_path = os.path.join(*path_parts[:i+1])
-            if any(fnmatch.fnmatch(partial_path, pattern) for pattern in IGNORE_PATHS):
-                return True
-        return False
+        path = Path(path)
+        if path.is_absolute():
+            path = path.relative_to(self.root_dir)
+        return self.ignore.match(path.as_posix())
+
+    def walk(self, root) -> Iterator[Tuple[Path, str]]:
+        """(path, path relative to `root`) of every included file, in sorted order.
+        Ignored directories are pruned before the walk descends into them."""
+        root = Path(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = Path(dirpath).relative_to(root).as_posix()
+            rel_dir = "" if rel_dir == "." else rel_dir
+            if ".gitignore" in filenames:
+                self.ignore.add_gitignore(Path(dirpath) / ".gitignore", rel_dir)
+            dirnames[:] = sorted(
+                d for d in dirnames if not self.ignore.match(f"{rel_dir}/{d}" if rel_dir else d, is_dir=True)
+            )
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1] not in self.extensions:
+                    continue
+                rel_path = f"{rel_dir}/{filename}" if rel_dir else filename
+                if not self.ignore.match(rel_path):
+                    yield Path(dirpath) / filename, rel_path
 
     @cached_property
     def file_contents(self):
-        contents = {}
-        for file_path in self.get_files():
-            if not self.should_ignore(file_path):
-                content = self.read_file(file_path)
-                if content is not None:
-                    contents[str(file_path)] = content
-        return contents
+        return {str(record["path"]): record["content"] for record in self.records if record["content"] is not None}
 
     def _generate_directory_structure(self):
-        tree = {}
-        for file_path in self.file_contents.keys():
-            parts = Path(file_path).parts
-            current = tree
-            for part in parts[:-1]:
-                current = current.setdefault(part, {})
-            current[parts[-1]] = None
-
-        def build_tree(node, prefix=""):
-            lines = []
-            items = sorted(node.items())
-            for i, (name, subtree) in enumerate(items):
-                is_last = i == len(items) - 1
-                lines.append(f"{prefix}{'└── ' if is_last else '├── '}{name}")
-                if subtree is not None:
-                    lines.extend(build_tree(subtree, prefix + ("    " if is_last else "│   ")))
-            return lines
-
-        return "\n".join(build_tree(tree))
+        return format_path_tree(build_path_tree(self.file_contents.keys()))
 
-    @cached_property
+    @property
     @abstractmethod
-    def markdown(self):
+    def markdown_header(self) -> str:
         pass
 
-    def save_markdown(self, output_file):
+    def markdown_sections(self, file_contents: Iterable[Tuple[str, str]], directory_structure: str) -> Iterator[str]:
+        yield self.markdown_header
+        yield f"\n## Directory Structure\n\n```\n{directory_structure}\n```\n"
+        for relative_path, content in file_contents:
+            yield self.markdown_file_section(relative_path, content)
+
+    @staticmethod
+    def markdown_file_section(relative_path: str, content: str) -> str:
+        return f"\n## {relative_path}\n\n```{Path(relative_path).suffix.lstrip('.')}\n{content}\n```\n"
+
+    def iter_markdown(self, chunk_size: int = 1 << 20) -> Iterator[str]:
+        """The markdown in chunks. The directory tree comes first but lists only files
+        that produced content, so file sections are spooled as files are processed,
+        spilling to disk past REPO2LLM_SPOOL_MAX_BYTES, and replayed after the tree."""
+        paths = []
+        with tempfile.SpooledTemporaryFile(max_size=REPO2LLM_SPOOL_MAX_BYTES, mode="w+", encoding="utf-8") as spool:
+            for record in self.iter_records():
+                if record["content"] is None:
+                    continue
+                paths.append(str(record["path"]))
+                spool.write(self.markdown_file_section(str(record["path"]), record["content"]))
+            yield from self.markdown_sections([], format_path_tree(build_path_tree(paths)))
+            spool.seek(0)
+            yield from iter(lambda: spool.read(chunk_size), "")
+
+    def write_markdown(self, out: TextIO) -> int:
+        """Stream the markdown to a text file object (e.g. an open file, or a socket's
+        `makefile("w")`); returns the number of characters written."""
+        num_chars = 0
+        for section in self.iter_markdown():
+            out.write(section)
+            num_chars += len(section)
+        return num_chars
+
+    @cached_property
+    def markdown(self):
+        """The whole markdown as one string; prefer `write_markdown` for large repositories."""
+        return "".join(self.iter_markdown())
+
+    def save_markdown(self, output_file, clipboard: bool = True):
+        """Stream the markdown to `output_file`. With `clipboard`, it is then read back
+        and copied, which needs the whole document in memory at once."""
         with open(output_file, "w") as out:
-            out.write(self.markdown)
+            self.write_markdown(out)
         print(f"Repository contents written to {output_file}")
+        if self.snapshot is not None:
+            stats = self.snapshot.stats
+            print(f"Reused {stats['reused']} cached files, rebuilt {stats['rebuilt']}, dropped {stats['deleted']}")
+        if not clipboard:
+            return
         try:
             import pyperclip
-            pyperclip.copy(self.markdown)
+            with open(output_file, "r") as f:
+                pyperclip.copy(f.read())
             print(f"Contents copied to clipboard")
         except Exception as e:
             print(f"!! COULD NOT COPY TO CLIPBOARD: {e}")
             pass
 
 class LocalReader(BaseRepoReader):
-    def __init__(self, root_dir, extensions=None):
+    def __init__(self, root_dir, extensions=None, use_snapshot: bool = REPO2LLM_SNAPSHOT, **kwargs):
         self.root_dir = Path(root_dir).resolve()
-        super().__init__(extensions)
-        self.gitignore_specs = self._parse_gitignores()
+        self.use_snapshot = use_snapshot
+        super().__init__(extensions, **kwargs)
 
-    def _parse_gitignores(self):
-        from pathspec import PathSpec
-        from pathspec.patterns import GitWildMatchPattern
-        gitignore_path = self.root_dir / '.gitignore'
-        if gitignore_path.exists():
-            with open(gitignore_path, 'r') as f:
-                return PathSpec.from_lines(GitWildMatchPattern, f)
-        return None
+    def new_snapshot(self) -> Optional[RepoSnapshot]:
+        return RepoSnapshot(self.root_dir) if self.use_snapshot else None
 
-    def should_ignore(self, path):
-        if super().should_ignore(path):
-            return True
-        
-        if self.gitignore_specs:
-            relative_path = path.relative_to(self.root_dir)
-            if self.gitignore_specs.match_file(str(relative_path)):
-                return True
-        
-        return False
+    def full_path(self, file_path) -> Path:
+        return self.root_dir / file_path
 
     def get_files(self):
-        for root, _, filenames in sorted(os.walk(self.root_dir)):
-            rootpath = Path(root)
-            if self.should_ignore(rootpath): continue
-            for filename in filenames:
-                file_path = rootpath / filename
-                if not self.should_ignore(file_path) and file_path.suffix in self.extensions:
-                    yield file_path
+        # a fresh matcher per walk, so edited .gitignore files are picked up
+        self.ignore = IgnoreMatcher()
+        for file_path, _ in self.walk(self.root_dir):
+            yield file_path
 
     def read_file(self, file_path):
         full_path = self.root_dir / file_path
@@ -157,31 +459,37 @@ class LocalReader(BaseRepoReader):
             return None
 
 
-    @cached_property
-    def markdown(self):
-        output = []
-        output.append("# Local Files and Directories\n")
-        output.append("This file contains truncated contents for LLM consumption. It provides an overview of the code structure and contents in the specified files and directories, with comments removed for brevity.\n")
-        
-        output.append("## Directory Structure\n")
-        output.append("```")
-        output.append(self._generate_directory_structure())
-        output.append("```\n")
-        
-        for relative_path, content in self.file_contents.items():
-            output.append(f"## {relative_path}\n")
-            output.append(f"```{Path(relative_path).suffix.lstrip('.')}")
-            output.append(content)
-            output.append("```\n")
-        
-        return "\n".join(output)
+    @property
+    def markdown_header(self) -> str:
+        return (
+            "# Local Files and Directories\n\n"
+            "This file contains truncated contents for LLM consumption. It provides an overview of the code structure and contents in the specified files and directories, with comments removed for brevity.\n"
+        )
 
 class GitHubRepoReader(BaseRepoReader):
-    def __init__(self, github_url, extensions=None):
-        super().__init__(extensions)
+    def __init__(self, github_url, extensions=None, **kwargs):
+        super().__init__(extensions, **kwargs)
         self.url, self.branch, self.username, self.repo = self._normalize_url(github_url)
         self.temp_dir = None
 
+    @property
+    def root_dir(self) -> Path:
+        return Path(self.temp_dir)
+
+    def full_path(self, file_path) -> Path:
+        return Path(self.temp_dir) / file_path
+
+    @contextmanager
+    def opened(self):
+        if self.temp_dir is not None:
+            yield
+            return
+        self.clone_repo()
+        try:
+            yield
+        finally:
+            self.cleanup()
+
     def _normalize_url(self, url):
         if '.com/' not in url:
             url=f'https://github.com/{url}'
@@ -212,19 +520,16 @@ class GitHubRepoReader(BaseRepoReader):
     def cleanup(self):
         if self.temp_dir and os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir)
+        self.temp_dir = None
 
     def get_files(self):
-        self.clone_repo()
-        try:
-            for root, _, files in os.walk(self.temp_dir):
-                for file in files:
-                    if file not in IGNORE_PATHS:
-                        file_path = Path(root) / file
-                        relative_path = file_path.relative_to(self.temp_dir)
-                        if not self.should_ignore(relative_path) and file_path.suffix in self.extensions:
-                            yield relative_path
-        finally:
-            self.cleanup()
+        if self.temp_dir is None:
+            with self.opened():
+                yield from self.get_files()
+            return
+        self.ignore = IgnoreMatcher()
+        for file_path, relative_path in self.walk(self.temp_dir):
+            yield Path(relative_path)
 
     def read_file(self, file_path):
         full_path = Path(self.temp_dir) / file_path
@@ -236,26 +541,247 @@ class GitHubRepoReader(BaseRepoReader):
             logger.warning(f"Unable to read {full_path} as text. Skipping.")
             return None
 
-    @cached_property
-    def markdown(self):
-        output = []
-        output.append(f"# GitHub Repository: {self.username}/{self.repo}\n")
-        output.append("This file contains truncated repository contents for LLM consumption. It provides an overview of the code structure and contents in this GitHub repository, with comments removed for brevity.\n")
-        
-        output.append("## Directory Structure\n")
-        output.append("```")
-        output.append(self._generate_directory_structure())
-        output.append("```\n")
-        
-        for relative_path, content in self.file_contents.items():
-            output.append(f"## {relative_path}\n")
-            output.append(f"```{Path(relative_path).suffix.lstrip('.')}")
-            output.append(content)
-            output.append("```\n")
-        
-        return "\n".join(output)
+    @property
+    def markdown_header(self) -> str:
+        return (
+            f"# GitHub Repository: {self.username}/{self.repo}\n\n"
+            "This file contains truncated repository contents for LLM consumption. It provides an overview of the code structure and contents in this GitHub repository, with comments removed for brevity.\n"
+        )
+
+def walk_order(path_rel: str) -> Tuple[Tuple[str, ...], str]:
+    """Sort key matching `BaseRepoReader.walk`: a directory's files before its subdirectories'."""
+    path = Path(path_rel)
+    return path.parent.parts, path.name
+
+
+class RepoWatcher:
+    """Keeps a LocalReader's markdown current while files change.
+
+    Change notifications come from watchdog when it is installed, else from polling
+    the (pruned) tree for new mtimes and sizes. A burst of events is debounced into
+    one update, which re-ingests only the files named in it, patches the directory
+    tree, and rewrites the output. Edits to a .gitignore, or new and moved
+    directories, fall back to a full pass, which the snapshot keeps cheap.
+    """
 
-def main(source_or_paths, extensions=REPO2LLM_EXTENSIONS, output_file='.robots.md'):
+    def __init__(
+        self,
+        reader: "LocalReader",
+        output_file: Union[str, Path],
+        debounce: float = REPO2LLM_WATCH_DEBOUNCE,
+        poll_interval: float = REPO2LLM_WATCH_POLL_INTERVAL,
+    ):
+        self.reader = reader
+        self.root_dir = reader.root_dir
+        self.output_file = Path(output_file).resolve()
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.tree: Dict[str, Any] = {}
+        self.pending: Set[str] = set()
+        self.rescan = False
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.num_updates = 0
+
+    def relative(self, path: Union[str, Path]) -> Optional[str]:
+        try:
+            path_rel = Path(path).resolve().relative_to(self.root_dir).as_posix()
+        except ValueError:
+            return None
+        return None if path_rel == "." else path_rel
+
+    @property
+    def output_rel(self) -> Optional[str]:
+        return self.relative(self.output_file)
+
+    def notify(self, path: Union[str, Path], rescan: bool = False):
+        """Record a change; called from the watchdog or polling thread."""
+        path_rel = self.relative(path)
+        if path_rel is None or path_rel == self.output_rel:
+            return
+        with self.lock:
+            self.pending.add(path_rel)
+            self.rescan = self.rescan or rescan
+        self.changed.set()
+
+    @contextmanager
+    def watching(self):
+        try:
+            from watchdog.observers import Observer
+        except ImportError:
+            logger.info("watchdog is not installed; polling for changes")
+            with self.polling():
+                yield
+            return
+        from watchdog.events import FileSystemEventHandler
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type in {"opened", "closed_no_write"}:
+                    return
+                if event.is_directory and event.event_type == "modified":
+                    return
+                rescan = event.is_directory and event.event_type in {"created", "moved"}
+                watcher.notify(event.src_path, rescan=rescan)
+                if getattr(event, "dest_path", ""):
+                    watcher.notify(event.dest_path, rescan=rescan)
+
+        observer = Observer()
+        observer.schedule(Handler(), str(self.root_dir), recursive=True)
+        observer.start()
+        try:
+            yield
+        finally:
+            observer.stop()
+            observer.join()
+
+    @contextmanager
+    def polling(self):
+        # a reader of its own, so its walk never races the main thread's matcher
+        scanner = LocalReader(self.root_dir, self.reader.extensions, use_snapshot=False)
+        stop = threading.Event()
+
+        def scan() -> Dict[str, Tuple[int, int]]:
+            stats = {}
+            paths = list(scanner.get_files())
+            for path in paths + scanner.ignore.gitignores:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[str(path)] = (st.st_mtime_ns, st.st_size)
+            return stats
+
+        def run(stats):
+            while not stop.wait(self.poll_interval):
+                new_stats = scan()
+                for path in stats.keys() | new_stats.keys():
+                    if stats.get(path) != new_stats.get(path):
+                        self.notify(path)
+                stats = new_stats
+
+        thread = threading.Thread(target=run, args=(scan(),), name="RepoWatcher", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def rebuild(self):
+        self.records = {
+            record["path_rel"]: record
+            for record in self.reader.iter_records()
+            if record["path_rel"] != self.output_rel
+        }
+        self.tree = build_path_tree(str(record["path"]) for record in self.records.values() if record["content"] is not None)
+
+    def ignored_dir(self, path_rel: str) -> bool:
+        parents = list(Path(path_rel).parents)[-2::-1]
+        return any(self.reader.ignore.match(parent.as_posix(), is_dir=True) for parent in parents)
+
+    def included(self, path_rel: str) -> bool:
+        return (
+            Path(path_rel).suffix in self.reader.extensions
+            and not self.ignored_dir(path_rel)
+            and not self.reader.ignore.match(path_rel)
+        )
+
+    def update(self) -> bool:
+        """Apply the pending changes; True if the output needs rewriting."""
+        with self.lock:
+            paths, rescan = self.pending, self.rescan
+            self.pending, self.rescan = set(), False
+        if rescan or any(Path(p).name == ".gitignore" and not self.ignored_dir(p) for p in paths):
+            self.rebuild()
+            return True
+        changed = False
+        for path_rel in sorted(paths):
+            if self.ignored_dir(path_rel):
+                continue
+            full_path = self.root_dir / path_rel
+            if full_path.is_file() and self.included(path_rel):
+                changed = self.refresh(full_path, path_rel) or changed
+            else:
+                changed = self.discard(path_rel) or changed
+        if self.reader.snapshot is not None:
+            self.reader.snapshot.flush()
+        return changed
+
+    def refresh(self, full_path: Path, path_rel: str) -> bool:
+        record = self.reader.ingest(full_path)
+        if self.reader.snapshot is not None:
+            self.reader.snapshot.observe(record)
+        old = self.records.get(path_rel)
+        self.records[path_rel] = record
+        old_content = old["content"] if old is not None else None
+        # the tree lists only files with content
+        if old_content is None and record["content"] is not None:
+            add_to_path_tree(self.tree, str(record["path"]))
+        elif old_content is not None and record["content"] is None:
+            remove_from_path_tree(self.tree, str(record["path"]))
+        return old_content != record["content"]
+
+    def discard(self, path_rel: str) -> bool:
+        record = self.records.pop(path_rel, None)
+        removed = [record] if record is not None else [
+            self.records.pop(p) for p in [p for p in self.records if p.startswith(path_rel + "/")]
+        ]
+        for record in removed:
+            if record["content"] is not None:
+                remove_from_path_tree(self.tree, str(record["path"]))
+            if self.reader.snapshot is not None:
+                self.reader.snapshot.forget(record["path_rel"])
+        return any(record["content"] is not None for record in removed)
+
+    def iter_markdown(self) -> Iterator[str]:
+        file_contents = (
+            (str(record["path"]), record["content"])
+            for _, record in sorted(self.records.items(), key=lambda item: walk_order(item[0]))
+            if record["content"] is not None
+        )
+        return self.reader.markdown_sections(file_contents, format_path_tree(self.tree))
+
+    @property
+    def markdown(self) -> str:
+        return "".join(self.iter_markdown())
+
+    def write(self):
+        tmp_file = self.output_file.with_name(self.output_file.name + ".tmp")
+        with open(tmp_file, "w") as out:
+            out.writelines(self.iter_markdown())
+        os.replace(tmp_file, self.output_file)
+        self.num_updates += 1
+
+    def wait(self):
+        """Block until a change arrives and then `debounce` seconds pass without another."""
+        self.changed.wait()
+        while True:
+            self.changed.clear()
+            if not self.changed.wait(self.debounce):
+                return
+
+    def run(self):
+        with self.watching():
+            self.rebuild()
+            self.write()
+            print(f"Repository contents written to {self.output_file}")
+            print(f"Watching {self.root_dir} for changes (Ctrl-C to stop)")
+            try:
+                while True:
+                    self.wait()
+                    started = time.perf_counter()
+                    if self.update():
+                        self.write()
+                        print(f"Updated {self.output_file} in {time.perf_counter() - started:.2f}s")
+            except KeyboardInterrupt:
+                pass
+
+
+def main(source_or_paths, extensions=REPO2LLM_EXTENSIONS, output_file='.robots.md', watch=False, debounce=REPO2LLM_WATCH_DEBOUNCE, clipboard=True):
     if isinstance(source_or_paths, str):
         if source_or_paths.startswith('http://') or source_or_paths.startswith('https://'):
             reader = GitHubRepoReader(source_or_paths, extensions)
@@ -274,4 +800,9 @@ def main(source_or_paths, extensions=REPO2LLM_EXTENSIONS, output_file='.robots.m
     else:
         output_file = Path.cwd() / ".robots.md"
 
-    reader.save_markdown(output_file)
\ No newline at end of file
+    if watch:
+        if not isinstance(reader, LocalReader):
+            raise ValueError("--watch needs a local path")
+        RepoWatcher(reader, output_file, debounce=debounce).run()
+    else:
+        reader.save_markdown(output_file, clipboard=clipboard)
\ No newline at end of file
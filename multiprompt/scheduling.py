@@ -0,0 +1,131 @@
+from .imports import *
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class FairScheduler:
+    """Admission control for server runs: a global cap, a per-client cap, and a
+    round-robin queue across clients so one busy client cannot starve the rest.
+
+    Requests that would wait longer than `max_wait` seconds, or arrive when
+    `max_queued` requests are already waiting, are rejected with AdmissionRejected.
+    """
+
+    def __init__(
+        self,
+        max_active: int = 16,
+        max_active_per_client: int = 2,
+        max_wait: Optional[float] = 30.0,
+        max_queued: Optional[int] = 256,
+    ):
+        self.max_active = max_active
+        self.max_active_per_client = max_active_per_client
+        self.max_wait = max_wait
+        self.max_queued = max_queued
+        self.active = 0
+        self.active_by_client: Counter = Counter()
+        # client -> waiting futures; dict order is the round-robin order
+        self.queues: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self.notifiers: Dict[asyncio.Future, Callable[[int], Awaitable]] = {}
+        self.num_admitted = 0
+        self.num_rejected = 0
+
+    @property
+    def num_queued(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": self.num_queued,
+            "clients_waiting": len(self.queues),
+            "admitted": self.num_admitted,
+            "rejected": self.num_rejected,
+        }
+
+    def can_run(self, client) -> bool:
+        return self.active < self.max_active and self.active_by_client[client] < self.max_active_per_client
+
+    def queue_position(self, client, future: asyncio.Future) -> int:
+        """1-based estimate of when `future` will be admitted under round-robin."""
+        queue = self.queues.get(client, ())
+        k = queue.index(future) if future in queue else 0
+        ahead = sum(min(len(q), k + 1) for c, q in self.queues.items() if c != client)
+        return ahead + k + 1
+
+    def grant(self, client):
+        self.active += 1
+        self.active_by_client[client] += 1
+        self.num_admitted += 1
+
+    async def acquire(self, client, notify: Optional[Callable[[int], Awaitable]] = None):
+        if client not in self.queues and self.can_run(client):
+            self.grant(client)
+            return
+        if self.max_queued is not None and self.num_queued >= self.max_queued:
+            self.num_rejected += 1
+            raise AdmissionRejected("Server is busy: too many queued requests")
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(client, deque()).append(future)
+        try:
+            if notify is not None:
+                self.notifiers[future] = notify
+                await notify(self.queue_position(client, future))
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not self.forget(client, future):
+                return  # admitted just as the deadline passed
+            self.num_rejected += 1
+            raise AdmissionRejected(f"Server is busy: no slot within {self.max_wait}s")
+        except BaseException:
+            # cancelled (or notify failed) while queued: give up the place, or the slot
+            # if it was granted meanwhile
+            if not self.forget(client, future):
+                self.release(client)
+            raise
+
+    def forget(self, client, future: asyncio.Future) -> bool:
+        """Drop a waiter that gave up; False if it had already been admitted."""
+        self.notifiers.pop(future, None)
+        queue = self.queues.get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.queues[client]
+        if future.done() and not future.cancelled():
+            return False
+        future.cancel()
+        return True
+
+    def release(self, client):
+        self.active -= 1
+        self.active_by_client[client] -= 1
+        if self.active_by_client[client] <= 0:
+            del self.active_by_client[client]
+        self.dispatch()
+
+    def dispatch(self):
+        admitted = True
+        while admitted and self.active < self.max_active:
+            admitted = False
+            for client in list(self.queues):
+                if not self.can_run(client):
+                    continue
+                queue = self.queues.pop(client)
+                future = queue.popleft()
+                if queue:
+                    self.queues[client] = queue  # back of the round-robin order
+                self.notifiers.pop(future, None)
+                self.grant(client)
+                future.set_result(True)
+                admitted = True
+                break
+        for client, queue in self.queues.items():
+            for future in queue:
+                notify = self.notifiers.get(future)
+                if notify is not None:
+                    asyncio.ensure_future(notify(self.queue_position(client, future)))
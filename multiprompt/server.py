@@ -2,8 +2,12 @@ from .imports import *
 from .utils import *
 from .conversations import *
 from .repo2llm import *
+from .scheduling import *
 
 import socketio
+import multiprocessing
+import zlib
+import socket
 from aiohttp import web
 
 logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
@@ -13,6 +17,125 @@ sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode="aiohttp")
 app = web.Application()
 sio.attach(app)
 
+EMIT_WINDOW = 0.02
+EMIT_MAX_TOKENS = 64
+EMIT_BATCH_FIELDS = ["position", "agent", "token_num", "token"]
+
+
+class EmitStats:
+    def __init__(self, window: int = 10000):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.num_tokens = 0
+        self.num_frames = 0
+
+    def record(self, enqueued_at: List[float]):
+        now = time.perf_counter()
+        self.latencies.extend(now - t for t in enqueued_at)
+        self.num_tokens += len(enqueued_at)
+        self.num_frames += 1
+
+    def reset(self):
+        self.__init__(self.latencies.maxlen)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        quantile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+        return {
+            "tokens": self.num_tokens,
+            "frames": self.num_frames,
+            "latency_p50": quantile(0.5),
+            "latency_p99": quantile(0.99),
+        }
+
+
+emit_stats = EmitStats()
+
+
+class TokenEmitter:
+    """Sends response tokens to one client, coalescing them into batch frames.
+
+    In "batch" mode tokens are buffered for up to `window` seconds or `max_tokens`
+    tokens and sent as one `response_batch` frame per conversation round:
+    {"conversation", "round", "fields": EMIT_BATCH_FIELDS, "tokens": [[...], ...]}.
+    In "token" mode (older frontends) every token is its own `response` event.
+    """
+
+    def __init__(self, sid: str, mode: str = "token", window: float = EMIT_WINDOW, max_tokens: int = EMIT_MAX_TOKENS):
+        self.sid = sid
+        self.mode = mode
+        self.window = window
+        self.max_tokens = max_tokens
+        self.buffer: List[Tuple[float, Dict[str, Any]]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    async def emit(self, response_d: Dict[str, Any]):
+        if self.mode != "batch":
+            enqueued_at = time.perf_counter()
+            await sio.emit("response", response_d, to=self.sid)
+            emit_stats.record([enqueued_at])
+            return
+        self.buffer.append((time.perf_counter(), response_d))
+        if len(self.buffer) >= self.max_tokens:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        buffer, self.buffer = self.buffer, []
+        frames = {}
+        for enqueued_at, d in buffer:
+            frame = frames.setdefault(
+                (d.get("conversation"), d.get("round")),
+                {"conversation": d.get("conversation"), "round": d.get("round"), "fields": EMIT_BATCH_FIELDS, "tokens": [], "enqueued_at": []},
+            )
+            frame["tokens"].append([d.get(field) for field in EMIT_BATCH_FIELDS])
+            frame["enqueued_at"].append(enqueued_at)
+        for frame in frames.values():
+            enqueued_at = frame.pop("enqueued_at")
+            await sio.emit("response_batch", frame, to=self.sid)
+            emit_stats.record(enqueued_at)
+
+
+emitters: Dict[str, TokenEmitter] = {}
+active_runs: Dict[str, Set[asyncio.Task]] = defaultdict(set)
+stream_stats: Counter = Counter()
+PARTIAL_OUTPUT_POLICY = DEFAULT_PARTIAL_OUTPUT_POLICY
+scheduler = FairScheduler(
+    max_active=SERVER_MAX_ACTIVE_RUNS,
+    max_active_per_client=SERVER_MAX_ACTIVE_RUNS_PER_CLIENT,
+    max_wait=SERVER_MAX_QUEUE_WAIT,
+    max_queued=SERVER_MAX_QUEUED_RUNS,
+)
+
+
+async def stats(request):
+    return web.json_response(
+        {
+            "streams": dict(stream_stats),
+            "emits": emit_stats.stats,
+            "scheduler": scheduler.stats,
+            "stash": STASH.stats,
+            "conversations": conversations.stats,
+            "attachments": ATTACHMENTS.stats,
+        }
+    )
+
+
+app.router.add_get("/stats", stats)
+
+
+def cancel_runs(sid: str) -> List[asyncio.Task]:
+    tasks = [task for task in active_runs.get(sid, ()) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    return tasks
+
 
 @sio.event
 async def connect(sid, environ):
@@ -27,20 +150,68 @@ async def connect(sid, environ):
 @sio.event
 async def disconnect(sid):
     logger.info(f"Client disconnected: {sid}")
+    cancelled = cancel_runs(sid)
+    if cancelled:
+        logger.info(f"Cancelled {len(cancelled)} converse run(s) for disconnected client {sid}")
+    emitter = emitters.pop(sid, None)
+    if emitter is not None and emitter.timer is not None:
+        emitter.timer.cancel()
+
+
+@sio.event
+async def stop(sid, data=None):
+    logger.info(f"Received stop event from client {sid}")
+    cancelled = cancel_runs(sid)
+    await asyncio.gather(*cancelled, return_exceptions=True)
+    if sid in emitters:
+        await emitters[sid].flush()
+    await sio.emit("conversation_stopped", {"cancelled": len(cancelled)}, to=sid)
 
 
 @sio.event
 async def converse(sid, data):
     logger.info(f"Received converse event from client {sid}")
     logger.debug(f"Converse data: {data}")
+    task = asyncio.ensure_future(run_converse(sid, data))
+    active_runs[sid].add(task)
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info(f"Converse run cancelled for client {sid}")
+    finally:
+        active_runs[sid].discard(task)
+        if not active_runs[sid]:
+            del active_runs[sid]
+
+
+async def run_converse(sid, data):
+    async def notify_queue_position(position):
+        await sio.emit("queue_position", {"position": position, "conversationId": data.get("conversationId")}, to=sid)
+
+    try:
+        await scheduler.acquire(sid, notify=notify_queue_position)
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected converse from client {sid}: {e}")
+        await sio.emit("rejected", {"message": str(e), "conversationId": data.get("conversationId")}, to=sid)
+        return
+    try:
+        await run_admitted_converse(sid, data)
+    finally:
+        scheduler.release(sid)
+
+
+async def run_admitted_converse(sid, data):
 
     user_prompt = data.get("userPrompt", "")
     # reference_prompt = data.get("referenceCodePrompt", "")
     attachments = data.get("attachments", [])
     agents_data = data.get("agents", [])
     conversation_id = data.get("conversationId")
+    emitter = emitters.get(sid)
+    if emitter is None or emitter.mode != data.get("emitMode", "token"):
+        emitter = emitters[sid] = TokenEmitter(sid, mode=data.get("emitMode", "token"))
 
-    conversation = Conversation(id=conversation_id, agents=agents_data)
+    conversation = await Conversation_async(id=conversation_id, agents=agents_data)
     conversation_round = conversation.add_round(
         user_prompt=user_prompt,
         attachments=attachments,
@@ -49,7 +220,8 @@ async def converse(sid, data):
     try:
         async for response_d in conversation_round.run_async():
             logger.debug(f"Emitting response to client {sid}: {response_d}")
-            await sio.emit("response", response_d, to=sid)
+            await emitter.emit(response_d)
+        await emitter.flush()
 
         logger.info(f"Conversation complete for client {sid}")
         await sio.emit(
@@ -58,8 +230,18 @@ async def converse(sid, data):
             to=sid,
         )
 
+    except asyncio.CancelledError:
+        stream_stats["cancelled_runs"] += 1
+        stream_stats["cancelled_streams"] += len(conversation_round.cancelled_agents)
+        try:
+            await asyncio.shield(conversation_round.cancel_async(policy=PARTIAL_OUTPUT_POLICY))
+        except ConversationConflict as e:
+            logger.warning(str(e))
+        raise
+
     except Exception as e:
         logger.error(f"Error in converse event: {str(e)}", exc_info=True)
+        await emitter.flush()
         await sio.emit("error", {"message": str(e)}, to=sid)
 
 
@@ -95,18 +277,177 @@ async def test_connection(sid):
     )
 
 
-async def main_async():
+async def main_async(
+    host: str = SERVER_HOST,
+    port: int = SERVER_PORT,
+    ready: Optional[Callable[[int], None]] = None,
+    sock: Optional[socket.socket] = None,
+):
+    """Serve on `host`:`port`, or on the already bound `sock`."""
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "localhost", 8989)
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+        host, port = sock.getsockname()[:2]
+    else:
+        site = web.TCPSite(runner, host, port)
     await site.start()
-    print("Server started at http://localhost:8989")
+    if ready is not None:
+        ready(port)
+    else:
+        print(f"Server started at http://{host}:{port}")
     await asyncio.Event().wait()  # run forever
 
 
-def main():
-    asyncio.run(main_async())
+def run_worker(ready: "multiprocessing.Queue"):
+    """Entry point of one worker process: serve on a port the OS picks, and report
+    that port once listening."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    try:
+        asyncio.run(main_async(ready=ready.put, sock=sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        STASH.flush()
+
+
+HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+SID_PATTERN = re.compile(r'"sid"\s*:\s*"([^"]+)"')
+
+
+class StickyProxy:
+    """Reverse proxy in front of the workers. New socket.io handshakes (and any other
+    request) go to the workers round-robin; the sid in a polling handshake's response
+    pins that session's later requests to the worker that issued it. A websocket
+    opened without a sid is a session of its own and stays on one connection."""
+
+    max_sessions = 65536
+
+    def __init__(self, worker_ports: List[int]):
+        self.worker_ports = worker_ports
+        self.next_worker = itertools.cycle(worker_ports)
+        self.sessions: "OrderedDict[str, int]" = OrderedDict()
+        self.session: Optional["aiohttp.ClientSession"] = None
+        self.app = web.Application()
+        self.app.on_startup.append(self.startup)
+        self.app.on_cleanup.append(self.cleanup)
+        self.app.router.add_route("*", "/{path:.*}", self.handle)
+
+    async def startup(self, app):
+        import aiohttp
+        self.session = aiohttp.ClientSession(auto_decompress=False)
+
+    async def cleanup(self, app):
+        await self.session.close()
+
+    def worker_port(self, request: web.Request) -> int:
+        sid = request.query.get("sid")
+        if sid is None:
+            return next(self.next_worker)
+        port = self.sessions.get(sid)
+        if port is None:
+            # a session from before a proxy restart: any stable choice will do
+            port = self.worker_ports[zlib.crc32(sid.encode()) % len(self.worker_ports)]
+        return port
+
+    def pin(self, body: bytes, port: int):
+        match = SID_PATTERN.search(body[:1024].decode("utf-8", "replace"))
+        if match is None:
+            return
+        self.sessions[match.group(1)] = port
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    @staticmethod
+    def is_handshake(request: web.Request) -> bool:
+        return request.path.startswith("/socket.io") and "sid" not in request.query
+
+    @staticmethod
+    def forward_headers(headers, drop: Set[str] = HOP_HEADERS) -> Dict[str, str]:
+        return {k: v for k, v in headers.items() if k.lower() not in drop}
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        port = self.worker_port(request)
+        url = f"http://127.0.0.1:{port}{request.rel_url}"
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            return await self.handle_websocket(request, url)
+        handshake = self.is_handshake(request)
+        # the request body has already been decoded by aiohttp; a handshake is
+        # fetched uncompressed so its sid can be read
+        drop = HOP_HEADERS | {"content-encoding"} | ({"accept-encoding"} if handshake else set())
+        async with self.session.request(
+            request.method,
+            url,
+            headers=self.forward_headers(request.headers, drop),
+            data=await request.read(),
+        ) as resp:
+            body = await resp.read()
+            if handshake and resp.status == 200:
+                self.pin(body, port)
+            return web.Response(status=resp.status, body=body, headers=self.forward_headers(resp.headers))
+
+    async def handle_websocket(self, request: web.Request, url: str) -> web.WebSocketResponse:
+        import aiohttp
+        ws_client = web.WebSocketResponse()
+        await ws_client.prepare(request)
+        headers = {k: v for k, v in self.forward_headers(request.headers).items() if not k.lower().startswith("sec-websocket")}
+        async with self.session.ws_connect(url, headers=headers) as ws_worker:
+
+            async def pump(source, dest):
+                async for msg in source:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        await dest.send_str(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.BINARY:
+                        await dest.send_bytes(msg.data)
+                    else:
+                        break
+
+            pumps = [asyncio.ensure_future(pump(ws_client, ws_worker)), asyncio.ensure_future(pump(ws_worker, ws_client))]
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+        await ws_client.close()
+        return ws_client
+
+
+def start_workers(num_workers: int) -> Tuple[List["multiprocessing.Process"], List[int]]:
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    workers = [ctx.Process(target=run_worker, args=(ready,), daemon=True) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    ports = [ready.get(timeout=60) for _ in workers]
+    return workers, ports
+
+
+def main(host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = SERVER_WORKERS):
+    """Serve in this process, or with `workers` > 1 run that many worker processes
+    behind a sticky proxy. Conversations are shared through the SQLite store."""
+    if workers <= 1:
+        try:
+            asyncio.run(main_async(host, port))
+        finally:
+            STASH.flush()
+        return
+
+    processes, worker_ports = start_workers(workers)
+    logger.info(f"Started {workers} workers on ports {worker_ports}")
+    try:
+        print(f"Server started at http://{host}:{port} with {workers} workers")
+        web.run_app(StickyProxy(worker_ports).app, host=host, port=port, print=None)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=10)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
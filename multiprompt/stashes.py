@@ -0,0 +1,342 @@
+import sys
+import atexit
+import logging
+import pickle
+import queue
+import threading
+from contextlib import nullcontext
+from functools import wraps
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+def estimate_size(obj: Any) -> int:
+    if isinstance(obj, (str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_size(x) for x in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+
+def dump_value(value: Any) -> Optional[bytes]:
+    """A value's pickle, or None if it cannot be pickled or does not load back (and so
+    is not cached, and is written synchronously)."""
+    try:
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(blob)
+        return blob
+    except Exception as e:
+        logger.debug(f"Not caching {type(value).__name__}: {e!r}")
+        return None
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the estimated size of its values in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key][0]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size: Optional[int] = None):
+        size = estimate_size(value) if size is None else size
+        with self.lock:
+            self.pop(key)
+            if size > self.max_bytes:
+                return
+            self.data[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.data.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value, size = self.data.pop(key)
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.data),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class StashWriter:
+    """Applies stash writes on a background thread so the event loop never waits on disk.
+
+    Values are queued as pickles taken at submit time, so later changes to the caller's
+    object never reach disk. Queued writes stay visible through `pending` until they
+    land, and each wake-up of the worker drains up to `batch_size` of them in one go.
+    `flush` blocks until the queue is empty and runs automatically at interpreter exit.
+    """
+
+    def __init__(self, batch_size: int = 64):
+        self.batch_size = batch_size
+        self.queue: "queue.Queue[Tuple[Any, Hashable, bytes, Any]]" = queue.Queue()
+        self.pending: Dict[Hashable, Deque[bytes]] = {}
+        self.lock = threading.Lock()
+        # held around every backend read and write, since stashes are not thread-safe;
+        # it also keeps readers from seeing a value both pending and on disk
+        self.io_lock = threading.Lock()
+        self.num_written = 0
+        self.num_batches = 0
+        self.thread = threading.Thread(target=self.run, name="StashWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, stash, key, blob: bytes, pending_key: Hashable):
+        with self.lock:
+            self.pending.setdefault(pending_key, deque()).append(blob)
+        self.queue.put((stash, key, blob, pending_key))
+
+    def get_pending(self, pending_key: Hashable) -> List[Any]:
+        with self.lock:
+            blobs = list(self.pending.get(pending_key, ()))
+        return [pickle.loads(blob) for blob in blobs]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for stash, key, blob, pending_key in batch:
+                with self.io_lock:
+                    try:
+                        stash.set(key, pickle.loads(blob))
+                        self.num_written += 1
+                    except Exception as e:
+                        logger.error(f"Background stash write failed: {e}")
+                    finally:
+                        with self.lock:
+                            values = self.pending.get(pending_key)
+                            if values:
+                                values.popleft()
+                                if not values:
+                                    del self.pending[pending_key]
+                        self.queue.task_done()
+            self.num_batches += 1
+
+    def flush(self):
+        self.queue.join()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.num_written,
+            "batches": self.num_batches,
+        }
+
+
+class CachedStash:
+    """In-memory LRU tier in front of a HashStash, written through on `set`.
+
+    Values are cached as pickles, sized by their length, and unpickled on every hit,
+    so callers get their own copy just as they would from disk. Sub-stashes share the
+    parent's LRU under their own namespace. Anything not overridden here is delegated
+    to the wrapped stash.
+    """
+
+    def __init__(
+        self,
+        stash,
+        max_bytes: int = 64 * 1024**2,
+        cache: Optional[LRUCache] = None,
+        namespace: Tuple[str, ...] = (),
+        writer: Optional[StashWriter] = None,
+    ):
+        self.stash = stash
+        self.cache = cache if cache is not None else LRUCache(max_bytes)
+        self.namespace = namespace
+        self._writer = writer
+
+    def __getattr__(self, name):
+        if name in {"stash", "_writer"}:
+            raise AttributeError(name)
+        attr = getattr(self.stash, name)
+        if self._writer is None or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def locked(*args, **kwargs):
+            with self._writer.io_lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+    def __repr__(self):
+        return f"CachedStash({self.stash!r})"
+
+    @property
+    def append_mode(self) -> bool:
+        return getattr(self.stash, "append_mode", False)
+
+    @property
+    def writer(self) -> StashWriter:
+        if self._writer is None:
+            self._writer = StashWriter()
+        return self._writer
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {**self.cache.stats, **(self._writer.stats if self._writer is not None else {})}
+
+    def io_lock(self):
+        """Context for touching the backend while the writer thread may be using it."""
+        return self._writer.io_lock if self._writer is not None else nullcontext()
+
+    def pending(self, key) -> List[Any]:
+        ckey = self.cache_key(key)
+        return self._writer.get_pending(ckey) if self._writer is not None and ckey is not None else []
+
+    def cache_key(self, key, kind="get"):
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return (self.namespace, kind, key)
+
+    def sub(self, name, **kwargs):
+        return self.__class__(
+            self.stash.sub(name, **kwargs),
+            cache=self.cache,
+            namespace=self.namespace + (name,),
+            writer=self.writer,
+        )
+
+    def __contains__(self, key):
+        ckey = self.cache_key(key)
+        if ckey is not None and ckey in self.cache:
+            self.cache.hits += 1
+            return True
+        with self.io_lock():
+            return bool(self.pending(key)) or key in self.stash
+
+    def get(self, key, default=None, **kwargs):
+        ckey = self.cache_key(key)
+        if ckey is None or kwargs:
+            with self.io_lock():
+                return self.stash.get(key, default, **kwargs)
+        blob = self.cache.get(ckey, MISSING)
+        if blob is not MISSING:
+            return pickle.loads(blob)
+        with self.io_lock():
+            pending = self.pending(key)
+            value = pending[-1] if pending else self.stash.get(key, MISSING)
+        if value is MISSING:
+            return default
+        self.cache_blobs(ckey, dump_value(value))
+        return value
+
+    def get_all(self, key, default=None, **kwargs):
+        ckey = self.cache_key(key, "all")
+        if ckey is None or kwargs:
+            with self.io_lock():
+                return self.stash.get_all(key, default, **kwargs)
+        blobs = self.cache.get(ckey, MISSING)
+        if blobs is not MISSING:
+            return [pickle.loads(blob) for blob in blobs]
+        with self.io_lock():
+            pending = self.pending(key)
+            values = self.stash.get_all(key, MISSING)
+        values = [] if values is MISSING or values is None else list(values)
+        values = values + pending if self.append_mode else (pending[-1:] or values)
+        if not values:
+            return default
+        if not pending:
+            self.cache_blobs(ckey, *[dump_value(value) for value in values])
+        return values
+
+    def cache_blobs(self, ckey, *blobs: Optional[bytes]):
+        """Cache one pickle under a get key, or a tuple of them under an all key."""
+        if any(blob is None for blob in blobs):
+            self.cache.pop(ckey)
+            return
+        value = blobs[0] if ckey[1] == "get" else tuple(blobs)
+        self.cache.set(ckey, value, size=sum(len(blob) for blob in blobs))
+
+    def set(self, key, value, **kwargs):
+        with self.io_lock():
+            self.stash.set(key, value, **kwargs)
+        self.remember(key, value)
+
+    def set_later(self, key, value):
+        """Like `set`, but the disk write happens on the background writer thread,
+        from a pickle of `value` taken now."""
+        ckey = self.cache_key(key)
+        blob = dump_value(value) if ckey is not None else None
+        if blob is None:
+            return self.set(key, value)
+        self.writer.submit(self.stash, key, blob, ckey)
+        self.remember(key, value, blob)
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
+
+    def remember(self, key, value, blob: Optional[bytes] = None):
+        ckey = self.cache_key(key)
+        if ckey is None:
+            return
+        blob = dump_value(value) if blob is None else blob
+        self.cache_blobs(ckey, blob)
+        ckey_all = self.cache_key(key, "all")
+        blobs = self.cache.pop(ckey_all, MISSING)
+        if blobs is not MISSING and self.append_mode:
+            self.cache_blobs(ckey_all, *blobs, blob)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+def stash_set_later(stash, key, value):
+    """Queue a background write when the stash supports it, else write now."""
+    if hasattr(stash, "set_later"):
+        stash.set_later(key, value)
+    else:
+        stash.set(key, value)
@@ -62,7 +62,74 @@ async def collect_async_generator(async_generator):
         result.append(item)
     return result
 
-def run_async(async_func, *args, **kwargs):
+async def merge_async_generators(generators, timeouts=None, cancel_on_error=True):
+    """Fan in several async generators, yielding (index, item) as soon as any of them produces.
+
+    Each generator is drained by its own task into a shared queue, so a slow source never
+    holds back the others. `timeouts` gives, per generator, the seconds to wait for its
+    next item; a source that errors or times out either cancels the rest and re-raises
+    (cancel_on_error) or is dropped with a warning. Closing the merged generator cancels
+    every source still running.
+    """
+    generators = list(generators)
+    timeouts = list(timeouts) if timeouts is not None else [None] * len(generators)
+    queue = asyncio.Queue()
+    done = object()
+
+    async def drain(i, gen, timeout):
+        try:
+            while True:
+                try:
+                    if timeout:
+                        item = await asyncio.wait_for(gen.__anext__(), timeout)
+                    else:
+                        item = await gen.__anext__()
+                except StopAsyncIteration:
+                    break
+                queue.put_nowait((i, item, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            queue.put_nowait((i, done, e))
+            return
+        queue.put_nowait((i, done, None))
+
+    tasks = [asyncio.ensure_future(drain(i, gen, timeout)) for i, (gen, timeout) in enumerate(zip(generators, timeouts))]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            i, item, error = await queue.get()
+            if item is done:
+                remaining -= 1
+                if error is not None:
+                    if cancel_on_error:
+                        raise error
+                    logger.warning(f"Dropping stream {i} after error: {error!r}")
+                continue
+            yield i, item
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for gen in generators:
+            if hasattr(gen, "aclose"):
+                await gen.aclose()
+
+def map_ordered(executor, func, *iterables, window: Optional[int] = None) -> Iterator[Any]:
+    """Like `executor.map`, but pulls inputs lazily and keeps at most `window` tasks
+    in flight, so results stream back in order with bounded memory."""
+    window = window or 2 * (getattr(executor, "_max_workers", None) or os.cpu_count() or 1)
+    pending = deque()
+    for args in zip(*iterables):
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_sync(coro_func, *args, **kwargs):
     try:
         loop = asyncio.get_event_loop()
     except RuntimeError:
@@ -71,9 +138,10 @@ def run_async(async_func, *args, **kwargs):
     
     if loop.is_running():
         nest_asyncio.apply()
-        return loop.run_until_complete(collect_async_generator(async_func(*args, **kwargs)))
-    else:
-        return loop.run_until_complete(collect_async_generator(async_func(*args, **kwargs)))
+    return loop.run_until_complete(coro_func(*args, **kwargs))
+
+def run_async(async_func, *args, **kwargs):
+    return run_sync(collect_async_generator, async_func(*args, **kwargs))
     
 def tokenize_agnostic(txt):
     return re.findall(r"[\w']+|[.,!?; -—–'\n]", txt)
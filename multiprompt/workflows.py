@@ -1,12 +1,15 @@
 from . import *
 
 class Workflow:
-    def __init__(self, agents: List['Agent']):
+    def __init__(self, agents: List[Union['Agent', List['Agent']]], max_concurrency: Optional[int] = DEFAULT_MAX_CONCURRENCY):
         assert len(agents)
+        self.max_concurrency = max_concurrency
         self.agentd = {}
-        for i,agent in enumerate(agents):
-            agent = agent.new(position=i+1)
-            self.agentd[(agent.position,agent.name)] = agent
+        for i,group in enumerate(agents):
+            # a nested list puts its agents in the same position, as in parse_agents_list
+            for agent in (group if isinstance(group, list) else [group]):
+                agent = agent.new(position=i+1)
+                self.agentd[(agent.position,agent.name)] = agent
         self._run = False
         self._prompt = None
         self.bad_cols = {'verbose','prompt','system_prompt','run'}
@@ -20,16 +23,31 @@ class Workflow:
         return [list(group) for _, group in itertools.groupby(sorted(self.agents, key=lambda agent: agent.position), key=lambda agent: agent.position)]
 
     def run(self, user_prompt=None, _force=False,**prompt_kwargs):
+        return run_sync(self.run_async, user_prompt=user_prompt, _force=_force, **prompt_kwargs)
+
+    async def run_async(self, user_prompt=None, _force=False, **prompt_kwargs):
         if not _force and self._prompt is not None: return self._prompt
         self._prompt = prompt = self.agents[0].prompt(user_prompt=user_prompt, **prompt_kwargs)
         user_prompt = prompt.user_prompt
+        semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
         for agents in self.agents_in_position:
-            for agent in agents:
-                agent.generate(prompt=prompt, _force=_force, repr=True)
-            for agent in agents:
-                prompt.messages.add_agent_message(agent, agent._prompt.response)
+            # agents in one position see the same prompt, so they can run side by side;
+            # gather keeps their responses in agent order
+            responses = await asyncio.gather(
+                *[self.generate_agent_async(agent, prompt, semaphore=semaphore, _force=_force) for agent in agents]
+            )
+            for agent, response in zip(agents, responses):
+                prompt.messages.add_agent_message(agent, response)
             prompt.messages.add_user_message(user_prompt)
         return prompt
+
+    async def generate_agent_async(self, agent, prompt, semaphore=None, _force=False):
+        if semaphore is None:
+            tokens = await collect_async_generator(agent.generate_async(prompt=prompt, _force=_force))
+        else:
+            async with semaphore:
+                tokens = await collect_async_generator(agent.generate_async(prompt=prompt, _force=_force))
+        return "".join(tokens)
         
     def run_df(self, user_prompt=None, _force=False, **prompt_kwargs):
         prompt = self.run(user_prompt=user_prompt, _force=_force, **prompt_kwargs)        
@@ -54,8 +72,8 @@ class Workflow:
             options.append(opt)
         for option in progress_bar(options, desc='Sweeping'):
             run+=1
-            agents = [agent.new(**option) for agent in self.agents]
-            new = self.__class__(agents)
+            agents = [[agent.new(**option) for agent in group] for group in self.agents_in_position]
+            new = self.__class__(agents, max_concurrency=self.max_concurrency)
             l.append(new.run_df(user_prompt=user_prompt, _force=_force, **prompt_kwargs).reset_index().assign(run=run))
         if not l: return pd.DataFrame()
         odf=pd.concat(l)
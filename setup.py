@@ -28,6 +28,10 @@ setup(
     ],
     python_requires=">=3.7",
     install_requires=requirements,
+    extras_require={
+        # the server benchmark drives the app with real socket.io clients
+        "bench": ["aiohttp", "python-socketio[asyncio_client]"],
+    },
     entry_points={
         "console_scripts": [
             # "multiprompt=multiprompt.server:main",
@@ -46,25 +46,38 @@ export const LLMProvider = ({ children }) => {
           addAgentToken(agent, token);
         };
 
+        const handleResponseBatch = (data) => {
+          const { fields, tokens } = data;
+          const agentIndex = fields.indexOf("agent");
+          const tokenIndex = fields.indexOf("token");
+          tokens.forEach((row) => addAgentToken(row[agentIndex], row[tokenIndex]));
+        };
+
         const handleConversationComplete = (data) => {
           console.log('Conversation complete:', data);
           socket.off("response", handleResponse);
+          socket.off("response_batch", handleResponseBatch);
           socket.off("conversation_complete", handleConversationComplete);
           socket.off("error", handleError);
+          socket.off("rejected", handleError);
           resolve(data);
         };
 
         const handleError = (error) => {
           console.error('Socket error:', error);
           socket.off("response", handleResponse);
+          socket.off("response_batch", handleResponseBatch);
           socket.off("conversation_complete", handleConversationComplete);
           socket.off("error", handleError);
+          socket.off("rejected", handleError);
           reject(error);
         };
 
         socket.on("response", handleResponse);
+        socket.on("response_batch", handleResponseBatch);
         socket.on("conversation_complete", handleConversationComplete);
         socket.on("error", handleError);
+        socket.on("rejected", handleError);
 
         socket.emit("converse", {
           userPrompt: combinedUserPrompt,
@@ -81,7 +94,8 @@ export const LLMProvider = ({ children }) => {
             temperature: agent.temperature,
             position: agent.position
           })),
-          conversationId: currentConversation.id
+          conversationId: currentConversation.id,
+          emitMode: "batch"
         });
       });
     },